@@ -0,0 +1,343 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import datetime
+import gzip
+import io
+import json
+import random
+import re
+import socket
+import threading
+import platform
+import sys
+import os
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import compression
+
+if platform.python_version().startswith('2'):
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote_plus
+    from urlparse import parse_qsl
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, unquote_plus
+
+
+DEFAULT_FIELDS = ['ym:pv:watchID', 'ym:pv:dateTime', 'ym:pv:date', 'ym:pv:clientID',
+                  'ym:pv:URL', 'ym:pv:browser', 'ym:pv:params']
+
+# Parts of names of string fields with (almost) unique values
+HIGH_CARDINALITY = ['URL', 'referer', 'title', 'ipAddress', 'GCLID', 'Phrase', 'UTMTerm']
+
+INT_RANGES = {
+    'UInt8': (0, 1),
+    'UInt16': (0, 1000),
+    'UInt32': (0, 1000000),
+    'UInt64': (0, 2 ** 63 - 1),
+    'Int16': (-1000, 1000),
+    'Int32': (-1000000, 1000000),
+    'Int64': (0, 100000)
+}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''Base handler supporting keep-alive and chunked request bodies'''
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Headers and body are written separately: avoid delayed ACK stalls
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        '''Yields request body by chunks'''
+        if self.headers.get('Transfer-Encoding', '') == 'chunked':
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            length = int(self.headers.get('Content-Length', 0))
+            if length:
+                yield self.rfile.read(length)
+
+    def send(self, code, body=b'', content_type='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeClickHouseHandler(Handler):
+    '''Stand-in for ClickHouse HTTP interface: keeps databases, columns
+    and create queries of tables to answer service queries and counts inserted
+    bytes and rows (rows of TSV only)'''
+
+    def do_POST(self):
+        stats = self.server.stats
+        if 'query=' in self.path:
+            codec = self.headers.get('Content-Encoding', 'none')
+            decompressor = None
+            if codec != 'none':
+                decompressor = compression.get_decompressor(codec)
+            size = 0
+            rows = 0
+            for chunk in self.read_body():
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                size += len(chunk)
+                rows += chunk.count(b'\n')
+            with self.server.lock:
+                stats['inserts'] += 1
+                stats['bytes'] += size
+                if 'TabSeparated' in unquote_plus(self.path):
+                    stats['rows'] += rows - 1  # header
+            return self.send(200)
+
+        query = b''.join(self.read_body()).decode('utf-8').strip()
+        with self.server.lock:
+            stats['queries'] += 1
+            return self.send(200, self.execute(query).encode('utf-8'))
+
+    def execute(self, query):
+        '''Returns result of service query'''
+        databases = self.server.databases
+        tables = self.server.tables
+        words = query.split()
+        if query.startswith('SHOW DATABASES'):
+            return '\n'.join(sorted(databases)) + '\n'
+        if query.startswith('EXISTS DATABASE'):
+            return '1\n' if words[2] in databases else '0\n'
+        if query.startswith('EXISTS TABLE'):
+            return '1\n' if words[2] in tables else '0\n'
+        if query.startswith('CREATE DATABASE'):
+            databases.add(words[-1])
+        elif query.startswith('CREATE TABLE'):
+            name = words[5] if words[2:5] == ['IF', 'NOT', 'EXISTS'] else words[2]
+            self.server.queries.setdefault(name, self.server.queries.get(words[4], query)
+                                           if words[3] == 'AS' else query)
+            if words[3] == 'AS':
+                tables.setdefault(name, list(tables.get(words[4], [])))
+            else:
+                columns = query[query.index('(') + 1:query.rindex(') ENGINE')]
+                tables.setdefault(name, [line.split()[0] for line in columns.split(',\n')
+                                         if line.strip()])
+        elif query.startswith('ALTER TABLE') and (words[3:5] == ['ADD', 'COLUMN']):
+            tables.get(words[2], []).append(words[8] if words[5] == 'IF' else words[5])
+        elif query.startswith('DROP TABLE'):
+            tables.pop(words[-1], None)
+            self.server.queries.pop(words[-1], None)
+        elif 'FROM system.columns' in query:
+            database, table = re.findall(r"'([^']*)'", query)[:2]
+            return '\n'.join(tables.get(database + '.' + table, [])) + '\n'
+        elif ('FROM system.tables' in query) and ('partition_key' in query):
+            match = re.search(r'PARTITION BY (\S+)', self.server.queries.get(
+                '.'.join(re.findall(r"'([^']*)'", query)[:2]), ''))
+            return (match.group(1) if match else '') + '\n'
+        elif 'FROM system.tables' in query:
+            return 'MergeTree\n'
+        return ''
+
+
+def generate_value(rnd, field, ch_type, date_str, i):
+    '''Returns random TSV value of ClickHouse type for Logs API field'''
+    if ch_type.startswith('Array('):
+        inner_type = ch_type[len('Array('):-1]
+        values = [generate_value(rnd, field, inner_type, date_str, i)
+                  for j in range(rnd.randint(0, 3))]
+        if inner_type in ['String', 'Date', 'DateTime']:
+            values = ["'" + value + "'" for value in values]
+        return '[' + ','.join(values) + ']'
+    if ch_type == 'Date':
+        return date_str
+    if ch_type == 'DateTime':
+        return '%s %02d:%02d:%02d' % (date_str, i // 3600 % 24, i // 60 % 60, i % 60)
+    if field.endswith('counterID'):
+        return str(rnd.randint(1, 3))
+    if ch_type in INT_RANGES:
+        return str(rnd.randint(*INT_RANGES[ch_type]))
+    if ch_type == 'Float64':
+        return '%.2f' % rnd.uniform(0, 1000)
+    if 'params' in field:
+        return '[{\\\'goal\\\': %d}]' % rnd.randint(1, 10) # escaped as in Logs API
+    if any(name in field for name in HIGH_CARDINALITY):
+        return 'https://example.com/catalog/%d?utm_source=%s' % (
+            rnd.randint(1, 100000), rnd.choice(['yandex', 'google', 'direct']))
+    return '%s_%d' % (field.split(':')[-1], rnd.randint(1, 20))
+
+
+def generate_part(rows, fields=DEFAULT_FIELDS, seed=0,
+                  start_date_str='2020-01-01', days=1):
+    '''Returns synthetic TSV part with header for Logs API fields,
+    values are generated according to types from configs/ch_types.json'''
+    with open(os.path.join(ROOT, 'configs', 'ch_types.json')) as input_file:
+        ch_types = json.loads(input_file.read())
+    rnd = random.Random(seed)
+    start_date = datetime.datetime.strptime(start_date_str, '%Y-%m-%d')
+    lines = ['\t'.join(fields)]
+    for i in range(rows):
+        date_str = (start_date + datetime.timedelta(i * days // rows)).strftime('%Y-%m-%d')
+        lines.append('\t'.join(generate_value(rnd, field, ch_types[field], date_str, i)
+                               for field in fields))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class FakeLogsApiHandler(Handler):
+    '''Stand-in for Logs API: evaluates, creates, reports status of,
+    serves parts of and cleans log requests. Parts are generated for fields
+    and dates of the request in background, so the request is processed
+    when they are ready. If server.part is set, it is served as any part'''
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path.endswith('/evaluate'):
+            return self.send_json({'log_request_evaluation': {
+                'possible': True, 'max_possible_day_quantity': 1000}})
+        if path.endswith('/logrequests'):
+            with self.server.lock:
+                requests = [self.get_info(request) for request in self.server.requests.values()]
+            return self.send_json({'requests': requests})
+        if path.endswith('/download'):
+            return self.download(path)
+        request = self.get_request(path)
+        if request is None:
+            return self.send(404)
+        with self.server.lock:
+            self.server.stats['polls'] += 1
+        return self.send_json({'log_request': self.get_info(request)})
+
+    def do_POST(self):
+        path = self.path.split('?')[0]
+        if path.endswith('/logrequests'):
+            return self.create(dict(parse_qsl(self.path.split('?', 1)[1])))
+        request = self.get_request(path[:-len('/clean')])
+        if (request is None) or (request['status'] != 'processed'):
+            return self.send(400)
+        with self.server.lock:
+            request['status'] = 'cleaned_by_user'
+            request['parts'] = []
+        return self.send_json({'log_request': self.get_info(request)})
+
+    def send_json(self, data):
+        self.send(200, json.dumps(data).encode('utf-8'), 'application/json')
+
+    def get_request(self, path):
+        request_id = path.rstrip('/').split('/')[-1]
+        with self.server.lock:
+            return self.server.requests.get(int(request_id)) if request_id.isdigit() else None
+
+    def get_info(self, request):
+        info = dict((key, request[key]) for key in
+                    ['request_id', 'counter_id', 'source', 'date1', 'date2', 'fields', 'status'])
+        if request['status'] == 'processed':
+            info['parts'] = [{'part_number': i, 'size': len(part)}
+                             for i, part in enumerate(request['parts'])]
+            info['size'] = sum(len(part) for part in request['parts'])
+        return info
+
+    def create(self, params):
+        server = self.server
+        with server.lock:
+            server.last_id += 1
+            request = {
+                'request_id': server.last_id,
+                'counter_id': int(self.path.split('/counter/')[1].split('/')[0]),
+                'source': params['source'],
+                'date1': params['date1'],
+                'date2': params['date2'],
+                'fields': params['fields'].split(','),
+                'status': 'created',
+                'parts': []
+            }
+            server.requests[request['request_id']] = request
+        thread = threading.Thread(target=self.prepare, args=(request,))
+        thread.daemon = True
+        thread.start()
+        self.send_json({'log_request': self.get_info(request)})
+
+    def prepare(self, request):
+        '''Generates parts of request, a few distinct ones are reused'''
+        date1 = datetime.datetime.strptime(request['date1'], '%Y-%m-%d')
+        date2 = datetime.datetime.strptime(request['date2'], '%Y-%m-%d')
+        parts = []
+        for i in range(min(self.server.parts, 4)):
+            parts.append(self.server.part or generate_part(
+                self.server.rows, request['fields'], seed=i,
+                start_date_str=request['date1'], days=(date2 - date1).days + 1))
+        with self.server.lock:
+            request['parts'] = [parts[i % len(parts)] for i in range(self.server.parts)]
+            request['status'] = 'processed'
+
+    def download(self, path):
+        if self.server.part is not None:
+            body = self.server.part
+        else:
+            request = self.get_request(path.split('/part/')[0])
+            part = int(path.split('/part/')[1].split('/')[0])
+            if (request is None) or (request['status'] != 'processed'):
+                return self.send(400)
+            body = request['parts'][part]
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = self.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.stats['downloads'] += 1
+            self.server.stats['bytes'] += len(body)
+
+    def compress(self, body):
+        '''Returns gzipped body, compressed once per distinct part'''
+        key = id(body)
+        with self.server.lock:
+            if key in self.server.gzipped:
+                return self.server.gzipped[key][1]
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1) as f:
+            f.write(body)
+        with self.server.lock:
+            # body is kept to make its id stable
+            self.server.gzipped[key] = (body, buf.getvalue())
+        return buf.getvalue()
+
+
+def start_server(handler, port=0):
+    '''Starts server in background thread, returns it with its url'''
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.lock = threading.Lock()
+    server.stats = {'inserts': 0, 'bytes': 0, 'rows': 0, 'queries': 0,
+                    'polls': 0, 'downloads': 0}
+    # state of ClickHouse stand-in
+    server.databases = set(['default'])
+    server.tables = {}
+    server.queries = {}
+    # state of Logs API stand-in
+    server.requests = {}
+    server.last_id = 0
+    server.gzipped = {}
+    server.part = None
+    server.parts = 1
+    server.rows = 10000
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
@@ -0,0 +1,48 @@
+'''Compares latency of service queries to ClickHouse stand-in made with
+a new connection per call (as module-level requests.post) and via pooled
+keep-alive client.
+
+    python benchmarks/http_pool.py [calls]
+'''
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import requests
+import http_client
+import fake_servers
+
+
+def measure(post, url, calls):
+    '''Returns latencies (ms) of calls'''
+    latencies = []
+    for i in range(calls):
+        start = time.time()
+        r = post(url, data='SHOW DATABASES')
+        r.raise_for_status()
+        latencies.append((time.time() - start) * 1000)
+    return sorted(latencies)
+
+
+def report(name, latencies):
+    print('{name:<12} mean {mean:7.3f} ms  p50 {p50:7.3f} ms  p99 {p99:7.3f} ms'.format(
+        name=name,
+        mean=sum(latencies) / len(latencies),
+        p50=latencies[len(latencies) // 2],
+        p99=latencies[int(len(latencies) * 0.99)]
+    ))
+
+
+if __name__ == '__main__':
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    server, url = fake_servers.start_server(fake_servers.FakeClickHouseHandler)
+    client = http_client.HttpClient()
+
+    report('per-call', measure(requests.post, url, calls))
+    report('pooled', measure(client.post, url, calls))
+    server.shutdown()
@@ -0,0 +1,122 @@
+'''Compares TSV and Native insert formats: client-side cost of conversion,
+size of sent data and throughput of inserts into ClickHouse stand-in.
+With --clickhouse also inserts into a real ClickHouse from configs/config.json
+(in a temporary database) and reports server-side time and CPU per format.
+
+    python benchmarks/insert_format.py [rows] [--clickhouse]
+'''
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import clickhouse
+import fake_servers
+import http_client
+import native
+import tsv
+import utils
+
+MB = 1024.0 * 1024
+DATABASE = 'logs_api_bench'
+FIELDS = ['ym:s:counterID', 'ym:s:visitID', 'ym:s:dateTime', 'ym:s:date',
+          'ym:s:clientID', 'ym:s:startURL', 'ym:s:referer', 'ym:s:browser',
+          'ym:s:regionCity', 'ym:s:pageViews', 'ym:s:visitDuration', 'ym:s:bounce',
+          'ym:s:goalsID', 'ym:s:goalsDateTime', 'ym:s:purchaseID',
+          'ym:s:purchaseRevenue', 'ym:s:productsName', 'ym:s:params']
+FORMATS = ['tsv', 'native']
+
+
+def get_part(rows):
+    '''Returns synthetic visits with ClickHouse column names in header'''
+    part = fake_servers.generate_part(rows, FIELDS, days=7)
+    header, body = part.split(b'\n', 1)
+    return tsv.rename_header(header, clickhouse.get_ch_field_name), body
+
+
+def get_encoder(header):
+    '''Returns Native encoder for columns of header'''
+    ch_field_types = utils.get_ch_fields_config()
+    return native.BlockEncoder(header, dict(
+        (clickhouse.get_ch_field_name(field), ch_field_types[field]) for field in FIELDS))
+
+
+def get_content(fmt, header, body, buffer_size=1048576):
+    '''Returns insert query (None for TSV) and chunks to send'''
+    blocks = tsv.iter_batches(body.split(b'\n')[:-1], buffer_size)
+    if fmt == 'tsv':
+        return None, [header + b'\n'] + list(blocks)
+    encoder = get_encoder(header)
+    return encoder.get_insert_query('{table}'), list(encoder.encode_blocks(blocks))
+
+
+def measure_insert(fmt, header, body, table, host):
+    '''Returns seconds of conversion and of whole insert and bytes sent'''
+    start = time.time()
+    query, content = get_content(fmt, header, body)
+    converted = time.time()
+    if query is not None:
+        query = query.format(table=table)
+    clickhouse.upload(table, iter(content), host=host, codec='none', query=query)
+    return converted - start, time.time() - start, sum(map(len, content))
+
+
+def get_server_stats(since):
+    '''Returns number, duration and user CPU time of inserts by format'''
+    clickhouse.get_clickhouse_data('SYSTEM FLUSH LOGS')
+    return clickhouse.get_clickhouse_data('''
+        SELECT
+            if(query LIKE '%FORMAT Native%', 'native', 'tsv') AS format,
+            count(),
+            sum(query_duration_ms),
+            round(sum(ProfileEvents['UserTimeMicroseconds']) / 1000)
+        FROM system.query_log
+        WHERE type = 'QueryFinish' AND event_time >= toDateTime({since})
+            AND query LIKE 'INSERT INTO {db}.%'
+        GROUP BY format ORDER BY format
+    '''.format(since=int(since), db=DATABASE))
+
+
+def measure_server(header, body, repeats=3):
+    '''Inserts data in both formats into real ClickHouse and prints server stats'''
+    since = time.time() - 1
+    clickhouse.get_clickhouse_data('CREATE DATABASE IF NOT EXISTS ' + DATABASE)
+    try:
+        table = DATABASE + '.visits'
+        clickhouse.get_clickhouse_data(
+            clickhouse.get_create_table_query(table, 'visits', FIELDS))
+        for i in range(repeats):
+            for fmt in FORMATS:
+                measure_insert(fmt, header, body, table, clickhouse.get_settings().host)
+        print('\nClickHouse server: format, inserts, duration ms, user CPU ms')
+        print(get_server_stats(since))
+    finally:
+        clickhouse.get_clickhouse_data('DROP DATABASE IF EXISTS ' + DATABASE)
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    rows = int(args[0]) if args else 200000
+    header, body = get_part(rows)
+    print('Part: %d rows, %.1f MB of TSV' % (rows, len(body) / MB))
+
+    ch_server, ch_url = fake_servers.start_server(
+        fake_servers.FakeClickHouseHandler)
+    print('\nInsert into ClickHouse stand-in')
+    for fmt in FORMATS:
+        convert, total, size = measure_insert(fmt, header, body, 'default.visits_all', ch_url)
+        print('{fmt:<8} sent {size:6.1f} MB  conversion {convert:6.2f} s  '
+              'total {total:6.2f} s  {speed:8.1f} MB/s of TSV  {rows:10.0f} rows/s'.format(
+                  fmt=fmt, size=size / MB, convert=convert, total=total,
+                  speed=len(body) / MB / total, rows=rows / total))
+    ch_server.shutdown()
+
+    if '--clickhouse' in sys.argv:
+        http_client.configure(utils.get_config())
+        measure_server(header, body)
@@ -0,0 +1,114 @@
+'''Measures the whole tool end to end without token and database:
+runs metrica_logs_api.py against local stand-ins of Logs API and ClickHouse
+for every requested part size and reports throughput, peak memory
+and latency of pipeline stages from the run report.
+
+    python benchmarks/pipeline.py [parts] [rows per part, comma separated] [parallel parts]
+'''
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, ROOT)
+
+import fake_servers
+
+MB = 1024.0 * 1024
+FIELDS = ['ym:pv:counterID', 'ym:pv:watchID', 'ym:pv:dateTime', 'ym:pv:date',
+          'ym:pv:clientID', 'ym:pv:URL', 'ym:pv:referer', 'ym:pv:browser',
+          'ym:pv:regionCity', 'ym:pv:screenWidth', 'ym:pv:params']
+
+# Runs the tool with Logs API host passed as the first argument
+RUNNER = '''
+import sys, runpy
+sys.path.insert(0, {root!r})
+import logs_api
+logs_api.HOST = sys.argv.pop(1)
+sys.argv[0] = 'metrica_logs_api.py'
+runpy.run_path({script!r}, run_name='__main__')
+'''.format(root=ROOT, script=os.path.join(ROOT, 'metrica_logs_api.py'))
+
+
+def prepare_dir(ch_url, parallel_parts):
+    '''Returns working directory with configs for the run'''
+    work_dir = tempfile.mkdtemp(prefix='logs_api_bench_')
+    shutil.copytree(os.path.join(ROOT, 'configs'), os.path.join(work_dir, 'configs'))
+    with open(os.path.join(ROOT, 'configs', 'config.json')) as input_file:
+        config = json.loads(input_file.read())
+    config.update({
+        'token': 'token',
+        'counter_id': '1',
+        'hits_fields': FIELDS,
+        'log_level': 'WARNING',
+        'parallel_parts': parallel_parts,
+        'polling_initial_delay': 0.1,
+        'polling_max_delay': 0.5,
+        'state_file': '',
+        'report_file': './report.json'
+    })
+    config['clickhouse']['host'] = ch_url
+    with open(os.path.join(work_dir, 'configs', 'config.json'), 'w') as output_file:
+        output_file.write(json.dumps(config, indent=2))
+    return work_dir
+
+
+def run(parts, rows, parallel_parts):
+    '''Runs the tool and returns its report, peak RSS (MB) and stats of stand-ins'''
+    logs_api_server, logs_api_url = fake_servers.start_server(
+        fake_servers.FakeLogsApiHandler)
+    logs_api_server.parts = parts
+    logs_api_server.rows = rows
+    ch_server, ch_url = fake_servers.start_server(fake_servers.FakeClickHouseHandler)
+    work_dir = prepare_dir(ch_url, parallel_parts)
+    try:
+        start = time.time()
+        process = subprocess.Popen(
+            [sys.executable, '-c', RUNNER, logs_api_url, '-source', 'hits',
+             '-start_date', '2020-01-01', '-end_date', '2020-01-07'],
+            cwd=work_dir)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - start
+        assert status == 0, 'Run failed'
+        with open(os.path.join(work_dir, 'report.json')) as input_file:
+            report = json.loads(input_file.read())
+    finally:
+        shutil.rmtree(work_dir)
+        logs_api_server.shutdown()
+        ch_server.shutdown()
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = usage.ru_maxrss / (MB if sys.platform == 'darwin' else 1024.0)
+    return report, rss, seconds, ch_server.stats
+
+
+def print_run(parts, rows, report, rss, seconds, ch_stats):
+    counters = report['counters']
+    print('\n{parts} parts x {rows} rows: {mb:.1f} MB, {secs:.1f} secs, peak RSS {rss:.0f} MB'.format(
+        parts=parts, rows=rows, mb=counters.get('bytes_downloaded', 0) / MB,
+        secs=seconds, rss=rss))
+    print('inserted {rows} rows, {mb:.1f} MB in {inserts} inserts'.format(
+        rows=ch_stats['rows'], mb=ch_stats['bytes'] / MB, inserts=ch_stats['inserts']))
+    print('throughput: ' + ', '.join('{0} {1}'.format(*item) for item in
+                                     sorted(report['throughput'].items())))
+    print('{stage:<12} {calls:>6} {total:>10} {avg:>10} {max:>10}'.format(
+        stage='stage', calls='calls', total='total, s', avg='avg, ms', max='max, ms'))
+    for stage, stats in sorted(report['stages'].items()):
+        print('{stage:<12} {calls:>6} {total:>10.2f} {avg:>10.1f} {max:>10.1f}'.format(
+            stage=stage, calls=stats['calls'], total=stats['seconds'],
+            avg=stats['seconds'] / stats['calls'] * 1000, max=stats['max_seconds'] * 1000))
+
+
+if __name__ == '__main__':
+    parts = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    part_rows = [int(rows) for rows in (sys.argv[2] if len(sys.argv) > 2 else '10000,100000').split(',')]
+    parallel_parts = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    for rows in part_rows:
+        report, rss, seconds, ch_stats = run(parts, rows, parallel_parts)
+        print_run(parts, rows, report, rss, seconds, ch_stats)
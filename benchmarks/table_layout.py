@@ -0,0 +1,98 @@
+'''Compares legacy and modern table layouts on a real ClickHouse
+from configs/config.json: loads the same synthetic hits into tables
+of both layouts and reports size on disk and timings of typical queries.
+Everything is created in a separate database which is dropped afterwards.
+
+    python benchmarks/table_layout.py [rows]
+'''
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import clickhouse
+import fake_servers
+import http_client
+import utils
+
+DATABASE = 'logs_api_bench'
+LAYOUTS = ['legacy', 'modern']
+FIELDS = ['ym:pv:counterID', 'ym:pv:watchID', 'ym:pv:dateTime', 'ym:pv:date',
+          'ym:pv:clientID', 'ym:pv:URL', 'ym:pv:referer', 'ym:pv:title',
+          'ym:pv:browser', 'ym:pv:operatingSystem', 'ym:pv:deviceCategory',
+          'ym:pv:regionCity', 'ym:pv:regionCountry', 'ym:pv:lastTrafficSource',
+          'ym:pv:screenWidth', 'ym:pv:screenHeight', 'ym:pv:notBounce']
+QUERIES = [
+    ('pageviews by day', '''
+        SELECT Date, count() FROM {table}
+        WHERE CounterID = 1 AND Date >= '2020-01-10' AND Date < '2020-01-17'
+        GROUP BY Date ORDER BY Date'''),
+    ('top browsers', '''
+        SELECT Browser, count() AS c FROM {table}
+        WHERE CounterID = 2 GROUP BY Browser ORDER BY c DESC LIMIT 10'''),
+    ('uniq clients by region', '''
+        SELECT RegionCity, uniq(ClientID) AS u FROM {table}
+        GROUP BY RegionCity ORDER BY u DESC LIMIT 10'''),
+    ('top URLs of a week', '''
+        SELECT URL, count() AS c FROM {table}
+        WHERE Date >= '2020-01-20' AND Date < '2020-01-27'
+        GROUP BY URL ORDER BY c DESC LIMIT 10''')
+]
+
+
+def load_table(layout, part):
+    '''Creates table of layout, loads part into it and returns its name'''
+    table = '{db}.hits_{layout}'.format(db=DATABASE, layout=layout)
+    clickhouse.get_clickhouse_data(
+        clickhouse.get_create_table_query(table, 'hits', FIELDS, layout))
+    clickhouse.upload(table, part)
+    clickhouse.get_clickhouse_data('OPTIMIZE TABLE {table} FINAL'.format(table=table))
+    return table
+
+
+def get_size(table):
+    '''Returns size of table's active parts on disk'''
+    database, name = table.split('.')
+    return int(clickhouse.get_clickhouse_data('''
+        SELECT sum(bytes_on_disk) FROM system.parts
+        WHERE database = '{db}' AND table = '{table}' AND active
+    '''.format(db=database, table=name)).strip() or 0)
+
+
+def measure(query, repeats=5):
+    '''Returns best time of query'''
+    timings = []
+    for i in range(repeats):
+        start = time.time()
+        clickhouse.get_clickhouse_data(query + ' FORMAT Null')
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    http_client.configure(utils.get_config())
+    part = fake_servers.generate_part(rows, FIELDS, days=31)
+    header, body = part.split(b'\n', 1)
+    header = '\t'.join(map(clickhouse.get_ch_field_name, header.decode('utf-8').split('\t')))
+    part = header.encode('utf-8') + b'\n' + body
+    print('Data: %d rows, %.1f MB of TSV' % (rows, len(part) / 1024.0 / 1024))
+
+    clickhouse.get_clickhouse_data('CREATE DATABASE IF NOT EXISTS ' + DATABASE)
+    try:
+        tables = [load_table(layout, part) for layout in LAYOUTS]
+        print('%-24s' % '' + ''.join('%12s' % layout for layout in LAYOUTS))
+        print('%-24s' % 'on disk, MB' + ''.join(
+            '%12.1f' % (get_size(table) / 1024.0 / 1024) for table in tables))
+        for name, query in QUERIES:
+            print('%-24s' % (name + ', ms') + ''.join(
+                '%12.1f' % (measure(query.format(table=table)) * 1000)
+                for table in tables))
+    finally:
+        clickhouse.get_clickhouse_data('DROP DATABASE IF EXISTS ' + DATABASE)
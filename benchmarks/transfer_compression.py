@@ -0,0 +1,95 @@
+'''Measures throughput of both legs of data transfer per compression codec:
+downloading a part from Logs API stand-in and inserting it into ClickHouse
+stand-in, plus compression ratio and speed of codecs themselves.
+
+    python benchmarks/transfer_compression.py [rows]
+'''
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import compression
+import clickhouse
+import fake_servers
+import http_client
+import tsv
+
+MB = 1024.0 * 1024
+
+
+def iter_chunks(data, size=1048576):
+    '''Yields data by chunks as they come from network'''
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def codecs():
+    '''Returns codecs available in this environment'''
+    return [codec for codec in compression.CODECS
+            if (codec != 'zstd') or (compression.zstandard is not None)]
+
+
+def measure_codec(part, codec):
+    '''Returns compression ratio and speed (MB/s) of codec'''
+    start = time.time()
+    size = sum(len(chunk) for chunk in compression.compress_stream(
+        tsv.iter_blocks(iter_chunks(part)), codec))
+    return len(part) / size, len(part) / MB / (time.time() - start)
+
+
+def measure_download(url, part, codec):
+    '''Returns throughput (MB/s of uncompressed data) of streamed download'''
+    client = http_client.HttpClient()
+    headers = {'Accept-Encoding': 'gzip' if codec == 'gzip' else 'identity'}
+    start = time.time()
+    r = client.get(url + '/part/0/download', headers=headers, stream=True)
+    size = sum(len(block) for block in tsv.iter_blocks(r.iter_content(1048576)))
+    assert size == len(part)
+    return size / MB / (time.time() - start)
+
+
+def measure_insert(url, part, codec):
+    '''Returns throughput (MB/s of uncompressed data) of streamed insert'''
+    start = time.time()
+    clickhouse.upload('default.hits_all',
+                      tsv.iter_blocks(iter_chunks(part)),
+                      host=url, codec=codec)
+    return len(part) / MB / (time.time() - start)
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    part = fake_servers.generate_part(rows)
+    print('Part: %d rows, %.1f MB' % (rows, len(part) / MB))
+
+    print('\nCodecs')
+    for codec in codecs():
+        ratio, speed = measure_codec(part, codec)
+        print('{codec:<8} ratio {ratio:5.2f}x  {speed:8.1f} MB/s'.format(
+            codec=codec, ratio=ratio, speed=speed))
+
+    logs_api_server, logs_api_url = fake_servers.start_server(
+        fake_servers.FakeLogsApiHandler)
+    logs_api_server.part = part
+    print('\nDownload from Logs API')
+    for codec in ['none', 'gzip']:
+        print('{codec:<8} {speed:8.1f} MB/s'.format(
+            codec=codec, speed=measure_download(logs_api_url, part, codec)))
+
+    ch_server, ch_url = fake_servers.start_server(
+        fake_servers.FakeClickHouseHandler)
+    print('\nInsert into ClickHouse')
+    for codec in codecs():
+        speed = measure_insert(ch_url, part, codec)
+        print('{codec:<8} {speed:8.1f} MB/s'.format(codec=codec, speed=speed))
+    assert ch_server.stats['bytes'] == len(part) * len(codecs())
+
+    logs_api_server.shutdown()
+    ch_server.shutdown()
@@ -0,0 +1,70 @@
+'''Microbenchmark of validation and transformation of Logs API parts:
+the former per-line implementation (split every line, filter, join,
+replace escapes in the whole text) versus block-level tsv.RowsTransformer.
+
+    python benchmarks/tsv_transform.py [rows]
+'''
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fake_servers
+import tsv
+
+MB = 1024.0 * 1024
+
+
+def transform_per_line(text):
+    '''Former implementation working with the whole decoded part'''
+    splitted_text = text.split('\n')
+    headers_num = len(splitted_text[0].split('\t'))
+    splitted_text_filtered = list(filter(lambda x: len(x.split('\t')) == headers_num,
+                                         text.split('\n')))
+    output_data = '\n'.join(splitted_text_filtered[1:])
+    output_data = splitted_text_filtered[0] + '\n' + output_data
+    return output_data.replace(r"\'", "'").encode('utf-8')
+
+
+def transform_blocks(data, use_numpy=False, chunk_size=1048576):
+    '''Streaming implementation over chunks of bytes'''
+    chunks = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+    header, blocks = tsv.split_header(tsv.iter_blocks(chunks))
+    transformer = tsv.RowsTransformer(header, use_numpy=use_numpy)
+    size = len(header) + 1
+    for block in transformer.transform_blocks(blocks):
+        size += len(block)
+    return size
+
+
+def measure(func, arg, repeats=3):
+    '''Returns best time of several runs'''
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        func(arg)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    part = fake_servers.generate_part(rows)
+    # a few broken rows as they happen in real parts
+    part += b'broken row\n' * 10
+
+    assert transform_blocks(part) == len(transform_per_line(part.decode('utf-8'))) + 1
+    print('Part: %d rows, %.1f MB' % (rows, len(part) / MB))
+    cases = [('per-line', transform_per_line, part.decode('utf-8')),
+             ('blocks', transform_blocks, part)]
+    if tsv.import_numpy() is not None:
+        cases.append(('numpy', lambda data: transform_blocks(data, True), part))
+    for name, func, arg in cases:
+        elapsed = measure(func, arg)
+        print('{name:<10} {secs:6.3f} s  {speed:8.1f} MB/s  {rows:10.0f} rows/s'.format(
+            name=name, secs=elapsed, speed=len(part) / MB / elapsed, rows=rows / elapsed))
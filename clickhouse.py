@@ -1,74 +1,155 @@
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
-import requests
+import compression
+import http_client
+import itertools
+import metrics
+import native
+import streams
+import tsv
 import urllib
 import urllib3
+import re
 import utils
 import sys
 import logging
-
-config = utils.get_config()
-CH_HOST = config['clickhouse']['host']
-CH_USER = config['clickhouse']['user']
-CH_PASSWORD = config['clickhouse']['password']
-CH_VISITS_TABLE = config['clickhouse']['visits_table']
-CH_HITS_TABLE = config['clickhouse']['hits_table']
-CH_DATABASE = config['clickhouse']['database']
-SSL_VERIFY = (config['disable_ssl_verification_for_clickhouse'] == 0)
+import threading
+import time
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 logger = logging.getLogger('logs_api')
 
-def get_clickhouse_data(query, host=CH_HOST):
-    '''Returns ClickHouse response'''
+# Settings of ClickHouse applied by configure()
+_settings = None
+_settings_lock = threading.Lock()
+
+# Column names and types of Logs API fields and renamed TSV headers,
+# dict operations are atomic, so values computed twice are harmless
+_names = {}
+_headers = {}
+_types = {}
+
+# Existence of database/tables and columns of tables resolved during the run
+_schema_cache = {}
+_schema_lock = threading.Lock()
+
+# Fields identifying rows of source, requested along with columns
+# added to rows which are already loaded
+KEY_FIELDS = {
+    'visits': ['ym:s:counterID', 'ym:s:date', 'ym:s:visitID'],
+    'hits': ['ym:pv:counterID', 'ym:pv:date', 'ym:pv:watchID']
+}
+
+# Partitions are rebuilt from the current table data while publishing,
+# so requests of the run are published one by one
+_publish_lock = threading.Lock()
+
+# Partition keys of tables in staging load mode: partitions of loaded days
+# are replaced whole, so rows of other days are never copied
+DAILY_PARTITION_KEYS = ['Date', 'toYYYYMMDD(Date)']
+
+def configure(config):
+    '''Applies ClickHouse settings from user config'''
+    global _settings
+    with _settings_lock:
+        _settings = utils.Structure(
+            host=config['clickhouse']['host'],
+            user=config['clickhouse']['user'],
+            password=config['clickhouse']['password'],
+            visits_table=config['clickhouse']['visits_table'],
+            hits_table=config['clickhouse']['hits_table'],
+            database=config['clickhouse']['database'],
+            compression=config['clickhouse']['compression'],
+            load_mode=config['clickhouse']['load_mode'],
+            table_layout=config['clickhouse']['table_layout'],
+            insert_format=config['clickhouse']['insert_format'],
+            insert_block_size=config['clickhouse']['insert_block_size'],
+            ssl_verify=(config['disable_ssl_verification_for_clickhouse'] == 0)
+        )
+    invalidate_schema_cache()
+
+
+def get_settings():
+    '''Returns applied settings, user config is read on first access
+    if nothing was applied, so importing the module is cheap'''
+    if _settings is None:
+        configure(utils.get_config())
+    return _settings
+
+
+def get_auth():
+    '''Returns credentials for requests or None'''
+    settings = get_settings()
+    if (settings.user == '') and (settings.password == ''):
+        return None
+    return (settings.user, settings.password)
+
+
+def get_clickhouse_data(query, host=None, settings=None, retries=None):
+    '''Returns ClickHouse response, settings are applied to the query only.
+    Queries which must not be repeated should be sent with retries=0'''
     logger.debug(query)
-    if (CH_USER == '') and (CH_PASSWORD == ''):
-        r = requests.post(host, data=query, verify=SSL_VERIFY)
-    else:
-        r = requests.post(host, data=query, auth=(CH_USER, CH_PASSWORD), verify=SSL_VERIFY)
+    r = http_client.get_client('clickhouse').post(host or get_settings().host, data=query,
+                                                  params=settings, auth=get_auth(),
+                                                  verify=get_settings().ssl_verify,
+                                                  retries=retries)
     if r.status_code == 200:
         return r.text
     else:
-        raise ValueError(r.text)
-
-
-def upload(table, content, host=CH_HOST):
-    '''Uploads data to table in ClickHous'''
-    content = content.encode('utf-8')
+        http_client.raise_error(r)
+
+
+def upload(table, content, host=None, codec=None, query=None):
+    '''Uploads data to table in ClickHouse.
+    Content is either a string or an iterable of byte chunks (sent chunked),
+    it is compressed unless codec is none (chunks on the fly).
+    Content is TSV with names unless insert query for another format is given'''
+    codec = codec or get_settings().compression
+    if not isinstance(content, bytes) and hasattr(content, 'encode'):
+        content = content.encode('utf-8')
+    headers = {}
+    if codec != 'none':
+        if isinstance(content, bytes):
+            # compressed at once, so it can be sent again on retries
+            content = b''.join(compression.compress_stream([content], codec))
+        else:
+            content = compression.compress_stream(content, codec)
+        headers['Content-Encoding'] = codec
+    # Streamed content can't be sent again, the part is retried instead
+    retries = None if isinstance(content, bytes) else 0
     query_dict = {
-             'query': 'INSERT INTO ' + table + ' FORMAT TabSeparatedWithNames '
+             'query': query or 'INSERT INTO ' + table + ' FORMAT TabSeparatedWithNames '
         }
-    if (CH_USER == '') and (CH_PASSWORD == ''):
-        r = requests.post(host, data=content, params=query_dict, verify=SSL_VERIFY)
-    else:
-        r = requests.post(host, data=content, params=query_dict, 
-                          auth=(CH_USER, CH_PASSWORD), verify=SSL_VERIFY)
+    r = http_client.get_client('clickhouse').post(
+        host or get_settings().host, data=content, params=query_dict, headers=headers,
+        auth=get_auth(), verify=get_settings().ssl_verify, retries=retries)
     result = r.text
     if r.status_code == 200:
         return result
     else:
-        raise ValueError(r.text)
+        http_client.raise_error(r)
 
 
 def get_source_table_name(source, with_db=True):
     '''Returns table name in database'''
+    settings = get_settings()
     if source == 'hits':
         if with_db:
-            return '{db}.{table}'.format(db=CH_DATABASE, table=CH_HITS_TABLE)
+            return '{db}.{table}'.format(db=settings.database, table=settings.hits_table)
         else:
-            return CH_HITS_TABLE
+            return settings.hits_table
     if source == 'visits':
         if with_db:
-            return '{db}.{table}'.format(db=CH_DATABASE, table=CH_VISITS_TABLE)
+            return '{db}.{table}'.format(db=settings.database, table=settings.visits_table)
         else:
-            return CH_VISITS_TABLE
+            return settings.visits_table
 
 
 def get_tables():
     '''Returns list of tables in database'''
-    return get_clickhouse_data('SHOW TABLES FROM {db}'.format(db=CH_DATABASE))\
+    return get_clickhouse_data('SHOW TABLES FROM {db}'.format(db=get_settings().database))\
         .strip().split('\n')
 
 def get_dbs():
@@ -77,20 +158,94 @@ def get_dbs():
         .strip().split('\n')
 
 
+def get_cached(key, resolve):
+    '''Returns schema property from cache resolving it on first access'''
+    with _schema_lock:
+        if key not in _schema_cache:
+            _schema_cache[key] = resolve()
+        return _schema_cache[key]
+
+
+def invalidate_schema_cache():
+    '''Forgets everything known about database schema'''
+    with _schema_lock:
+        _schema_cache.clear()
+
+
 def is_table_present(source):
     '''Returns whether table for data is already present in database'''
-    return get_source_table_name(source, with_db=False) in get_tables()
+    table = get_source_table_name(source)
+    return get_cached(
+        ('table', table),
+        lambda: get_clickhouse_data('EXISTS TABLE ' + table).strip() == '1'
+    )
 
 def is_db_present():
     '''Returns whether a database is already present in clickhouse'''
-    return CH_DATABASE in get_dbs()
+    return get_cached(
+        ('database', get_settings().database),
+        lambda: get_clickhouse_data('EXISTS DATABASE ' + get_settings().database).strip() == '1'
+    )
 
 def create_db():
     '''Creates database in clickhouse'''
-    return get_clickhouse_data('CREATE DATABASE {db}'.format(db=CH_DATABASE))
+    result = get_clickhouse_data('CREATE DATABASE IF NOT EXISTS {db}'.format(db=get_settings().database))
+    invalidate_schema_cache()
+    return result
 
 
-def get_ch_field_name(field_name):
+def get_table_columns(source):
+    '''Returns list of column names of table'''
+    table = get_source_table_name(source)
+    query = '''
+        SELECT name
+        FROM system.columns
+        WHERE database = '{db}' AND table = '{table}'
+    '''.format(db=get_settings().database, table=get_source_table_name(source, with_db=False))
+    return get_cached(
+        ('columns', table),
+        lambda: get_clickhouse_data(query).strip().split('\n')
+    )
+
+
+def get_table_engine(source):
+    '''Returns engine of table'''
+    query = '''
+        SELECT engine
+        FROM system.tables
+        WHERE database = '{db}' AND name = '{table}'
+    '''.format(db=get_settings().database, table=get_source_table_name(source, with_db=False))
+    return get_cached(
+        ('engine', get_source_table_name(source)),
+        lambda: get_clickhouse_data(query).strip()
+    )
+
+
+def get_partition_key(source):
+    '''Returns partition key expression of table'''
+    query = '''
+        SELECT partition_key
+        FROM system.tables
+        WHERE database = '{db}' AND name = '{table}'
+    '''.format(db=get_settings().database, table=get_source_table_name(source, with_db=False))
+    return get_cached(
+        ('partition_key', get_source_table_name(source)),
+        lambda: get_clickhouse_data(query).strip()
+    )
+
+
+def validate_table_columns(source, fields):
+    '''Checks that existing table has columns for all fields'''
+    missing = set(map(get_ch_field_name, fields)) - set(get_table_columns(source))
+    if missing:
+        raise ValueError(
+            'Table {table} has no columns for fields: {columns}. '
+            'Drop the table or add columns using ALTER TABLE'.format(
+                table=get_source_table_name(source),
+                columns=', '.join(sorted(missing))))
+
+
+def convert_field_name(field_name):
     '''Converts Logs API parameter name to ClickHouse column name'''
     prefixes = ['ym:s:', 'ym:pv:']
     for prefix in prefixes:
@@ -98,54 +253,134 @@ def get_ch_field_name(field_name):
     return field_name[0].upper() + field_name[1:]
 
 
+def get_ch_field_name(field_name):
+    '''Returns ClickHouse column name of Logs API parameter, names
+    are converted once per run'''
+    name = _names.get(field_name)
+    if name is None:
+        name = _names.setdefault(field_name, convert_field_name(field_name))
+    return name
+
+
+def get_ch_header(header):
+    '''Returns TSV header with ClickHouse column names, headers are
+    the same for all parts of a source, so each is renamed once per run'''
+    ch_header = _headers.get(header)
+    if ch_header is None:
+        ch_header = _headers.setdefault(header, tsv.rename_header(header, get_ch_field_name))
+    return ch_header
+
+
+def get_ch_types(fields):
+    '''Returns ClickHouse types of columns of fields by their names'''
+    key = tuple(fields)
+    ch_types = _types.get(key)
+    if ch_types is None:
+        ch_field_types = utils.get_ch_fields_config()
+        ch_types = _types.setdefault(key, dict(
+            (get_ch_field_name(field), ch_field_types[field]) for field in fields))
+    return ch_types
+
+
 def drop_table(source):
     '''Drops table in ClickHouse'''
     query = 'DROP TABLE IF EXISTS {table}'.format(
         table=get_source_table_name(source))
     get_clickhouse_data(query)
+    invalidate_schema_cache()
 
 
-def create_table(source, fields):
-    '''Creates table in ClickHouse for hits/visits with particular fields'''
+def get_legacy_engine(source, fields):
+    '''Returns engine statement in deprecated MergeTree syntax'''
+    prefix = 'ym:pv:' if source == 'hits' else 'ym:s:'
+    if (prefix + 'date' in fields) and (prefix + 'clientID' in fields):
+        return 'MergeTree(Date, intHash32(ClientID), (Date, intHash32(ClientID)), 8192)'
+    return 'Log'
+
+
+def uses_columns(expression, columns):
+    '''Returns whether all columns referenced in expression are present'''
+    names = re.findall(r'\b[A-Za-z_][A-Za-z0-9_]*\b(?!\s*\()', expression)
+    return all(name in columns for name in names)
+
+
+def get_engine(ch_fields, layout):
+    '''Returns MergeTree engine statement with partitioning, ordering
+    and sampling from layout config, skipping expressions over absent columns'''
+    statement = 'MergeTree'
+    if layout['partition_by'] and uses_columns(layout['partition_by'], ch_fields):
+        statement += '\n        PARTITION BY ' + layout['partition_by']
+
+    order_by = [key for key in layout['order_by'] if uses_columns(key, ch_fields)]
+    statement += '\n        ORDER BY ({keys})'.format(keys=', '.join(order_by)) \
+        if order_by else '\n        ORDER BY tuple()'
+
+    if layout['sample_by'] and (layout['sample_by'] in order_by):
+        statement += '\n        SAMPLE BY ' + layout['sample_by']
+    return statement
+
+
+def get_column_type(field, ch_type, layout):
+    '''Returns column type with codec according to layout config'''
+    if (ch_type == 'String') and layout['low_cardinality_strings'] \
+            and (field not in layout['high_cardinality_fields']):
+        ch_type = 'LowCardinality(String)'
+    if ch_type in layout['codecs']:
+        ch_type += ' CODEC({codec})'.format(codec=layout['codecs'][ch_type])
+    return ch_type
+
+
+def get_column_types(fields, table_layout=None):
+    '''Returns types of columns for fields according to table layout'''
+    table_layout = table_layout or get_settings().table_layout
+    ch_field_types = utils.get_ch_fields_config()
+    if table_layout == 'legacy':
+        return [ch_field_types[field] for field in fields]
+    layout = utils.get_ch_layout_config()
+    return [get_column_type(field, ch_field_types[field], layout) for field in fields]
+
+
+def get_create_table_query(table_name, source, fields, table_layout=None):
+    '''Returns query creating table for hits/visits with particular fields'''
+    table_layout = table_layout or get_settings().table_layout
     tmpl = '''
-        CREATE TABLE {table_name} (
+        CREATE TABLE IF NOT EXISTS {table_name} (
             {fields}
         ) ENGINE = {engine}
     '''
     field_tmpl = '{name} {type}'
     field_statements = []
 
-    table_name = get_source_table_name(source)
-    if source == 'hits':
-        if ('ym:pv:date' in fields) and ('ym:pv:clientID' in fields):
-            engine = 'MergeTree(Date, intHash32(ClientID), (Date, intHash32(ClientID)), 8192)'
-        else:
-            engine = 'Log'
+    ch_fields = list(map(get_ch_field_name, fields))
+    column_types = get_column_types(fields, table_layout)
 
-    if source == 'visits':
-        if ('ym:s:date' in fields) and ('ym:s:clientID' in fields):
-            engine = 'MergeTree(Date, intHash32(ClientID), (Date, intHash32(ClientID)), 8192)'
-        else:
-            engine = 'Log'
+    if table_layout == 'legacy':
+        engine = get_legacy_engine(source, fields)
+    else:
+        layout = utils.get_ch_layout_config()
+        if get_settings().load_mode == 'staging':
+            # Loaded days are published by replacing their partitions
+            layout = dict(layout, partition_by='Date')
+        engine = get_engine(ch_fields, layout)
 
-    ch_field_types = utils.get_ch_fields_config()
-    ch_fields = list(map(get_ch_field_name, fields))
-    
     for i in range(len(fields)):
-        field_statements.append(field_tmpl.format(name= ch_fields[i],
-            type=ch_field_types[fields[i]]))
-    
-    field_statements = sorted(field_statements)
-    query = tmpl.format(table_name=table_name,
-                        engine=engine,
-                        fields=',\n'.join(sorted(field_statements)))
+        field_statements.append(field_tmpl.format(name=ch_fields[i],
+                                                  type=column_types[i]))
 
-    get_clickhouse_data(query)
+    return tmpl.format(table_name=table_name,
+                       engine=engine,
+                       fields=',\n'.join(sorted(field_statements)))
 
 
-def save_data(source, fields, data):
-    '''Inserts data into ClickHouse table'''
+def create_table(source, fields):
+    '''Creates table in ClickHouse for hits/visits with particular fields'''
+    get_clickhouse_data(get_create_table_query(get_source_table_name(source),
+                                               source, fields))
+    invalidate_schema_cache()
+
 
+def prepare_table(source, fields):
+    '''Creates database and table if needed and validates table's columns'''
     if not is_db_present():
         logger.info('Database created')
         create_db()
@@ -154,27 +389,243 @@ def save_data(source, fields, data):
         logger.info('Table created')
         create_table(source, fields)
 
-    upload(get_source_table_name(source), data)
+    validate_table_columns(source, fields)
+    if get_settings().load_mode == 'staging':
+        assert get_table_engine(source).endswith('MergeTree'), \
+            'Staging load mode requires table of MergeTree family'
+        assert get_partition_key(source) in DAILY_PARTITION_KEYS, \
+            'Staging load mode requires table {table} partitioned by Date (PARTITION BY Date), ' \
+            'it has partition key "{key}"'.format(table=get_source_table_name(source),
+                                                  key=get_partition_key(source))
+
+
+def save_data(source, fields, data, table=None):
+    '''Inserts data into ClickHouse table (the one for source by default,
+    which is created or checked first). Data (TSV with names) bigger than
+    insert_block_size is inserted in several INSERTs split at boundaries
+    of its blocks'''
+    if table is None:
+        prepare_table(source, fields)
+        table = get_source_table_name(source)
+    header, blocks = tsv.split_header(data)
+    for group in streams.iter_groups(blocks, get_settings().insert_block_size):
+        if get_settings().insert_format == 'native':
+            upload_native(table, fields, header, group)
+        else:
+            upload(table, itertools.chain([header + b'\n'], group))
+        metrics.increment('inserts')
+
 
+def upload_native(table, fields, header, blocks):
+    '''Converts TSV blocks into Native format according to field types
+    from ch_types.json and uploads them to table'''
+    encoder = native.BlockEncoder(header, get_ch_types(fields))
+    upload(table, encoder.encode_blocks(blocks), query=encoder.get_insert_query(table))
 
-def is_data_present(start_date_str, end_date_str, source):
-    '''Returns whether there is a records in database for particular date range and source'''
+
+def get_loaded_dates(start_date_str, end_date_str, source, counter_id=None):
+    '''Returns set of dates of period which have records in database.
+    Only records of counter are taken into account if table has CounterID column'''
     if not is_db_present():
-        return False
+        return set()
 
     if not is_table_present(source):
-        return False
+        return set()
 
-    table_name = get_source_table_name(source)
     query = '''
-        SELECT count()
+        SELECT Date
         FROM {table}
         WHERE Date >= '{start_date}' AND Date <= '{end_date}'
-    '''.format(table=table_name,
+    '''.format(table=get_source_table_name(source),
                start_date=start_date_str,
                end_date=end_date_str)
+    if (counter_id is not None) and ('CounterID' in get_table_columns(source)):
+        query += ' AND CounterID = {counter_id}'.format(counter_id=int(counter_id))
+    query += ' GROUP BY Date'
+
+    return set(get_clickhouse_data(query).split())
+
+
+def get_staging_table_name(source, request_id, part=None, with_db=True):
+    '''Returns name of staging table for Logs API request or its part'''
+    table = '{table}_staging_{request_id}'.format(
+        table=get_source_table_name(source, with_db=with_db),
+        request_id=request_id)
+    if part is not None:
+        table += '_{part}'.format(part=part)
+    return table
+
 
-    visits = get_clickhouse_data(query, CH_HOST)
-    is_null = (visits == '') or (visits.strip() == '0')
-    return not is_null
+def create_staging_table(source, request_id, part=None):
+    '''Creates empty staging table with the structure of source table'''
+    table = get_staging_table_name(source, request_id, part)
+    get_clickhouse_data('DROP TABLE IF EXISTS {table}'.format(table=table))
+    get_clickhouse_data('CREATE TABLE {table} AS {source_table}'.format(
+        table=table, source_table=get_source_table_name(source)))
+    return table
 
+
+def get_partitions(table_name):
+    '''Returns list of IDs of active partitions of table in database'''
+    query = '''
+        SELECT DISTINCT partition_id
+        FROM system.parts
+        WHERE database = '{db}' AND table = '{table}' AND active
+    '''.format(db=get_settings().database, table=table_name)
+    return get_clickhouse_data(query).split()
+
+
+def publish_staging(source, request_id, parts, start_date_str, end_date_str,
+                    counter_id=None):
+    '''Moves data of Logs API request from staging tables of its parts into
+    source table. Partition of each loaded day is swapped atomically and all
+    data previously loaded for the day (and counter) is replaced, so
+    publishing is idempotent and never duplicates rows'''
+    staging = create_staging_table(source, request_id)
+    staging_name = get_staging_table_name(source, request_id, with_db=False)
+
+    for part in parts:
+        part_table = get_staging_table_name(source, request_id, part)
+        part_name = get_staging_table_name(source, request_id, part, with_db=False)
+        for partition in get_partitions(part_name):
+            get_clickhouse_data(
+                "ALTER TABLE {staging} ATTACH PARTITION ID '{partition}' FROM {part_table}"
+                .format(staging=staging, partition=partition, part_table=part_table),
+                retries=0)
+
+    with _publish_lock:
+        replace_partitions(source, staging, get_partitions(staging_name),
+                           start_date_str, end_date_str, counter_id)
+
+    for part in parts:
+        get_clickhouse_data('DROP TABLE IF EXISTS {table}'.format(
+            table=get_staging_table_name(source, request_id, part)))
+    get_clickhouse_data('DROP TABLE IF EXISTS {table}'.format(table=staging))
+
+
+def get_partition_date(partition):
+    '''Returns date of daily partition by its ID'''
+    return '{0}-{1}-{2}'.format(partition[:4], partition[4:6], partition[6:8])
+
+
+def replace_partitions(source, staging, partitions, start_date_str, end_date_str,
+                       counter_id=None):
+    '''Replaces daily partitions of source table with the ones of staging
+    table keeping rows of other counters'''
+    if not partitions:
+        return
+
+    table = get_source_table_name(source)
+    for partition in partitions:
+        if not (start_date_str <= get_partition_date(partition) <= end_date_str):
+            raise RuntimeError('{staging} has rows of {date} outside of loaded period {start} - {end}'
+                               .format(staging=staging, date=get_partition_date(partition),
+                                       start=start_date_str, end=end_date_str))
+
+    # Partitions are days of the period, so only rows of other counters are kept
+    if (counter_id is not None) and ('CounterID' in get_table_columns(source)):
+        get_clickhouse_data('''
+            INSERT INTO {staging}
+            SELECT *
+            FROM {table}
+            WHERE _partition_id IN ({partitions}) AND CounterID != {counter_id}
+        '''.format(staging=staging, table=table, counter_id=int(counter_id),
+                   partitions=', '.join("'%s'" % p for p in partitions)), retries=0)
+
+    for partition in partitions:
+        get_clickhouse_data(
+            "ALTER TABLE {table} REPLACE PARTITION ID '{partition}' FROM {staging}"
+            .format(table=table, partition=partition, staging=staging))
+    logger.info('%d partitions of %s replaced' % (len(partitions), table))
+
+
+def add_columns(source, fields):
+    '''Adds columns for fields which table lacks'''
+    columns = get_table_columns(source)
+    missing = [field for field in fields if get_ch_field_name(field) not in columns]
+    for field, column_type in zip(missing, get_column_types(missing)):
+        get_clickhouse_data('ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {name} {type}'.format(
+            table=get_source_table_name(source), name=get_ch_field_name(field),
+            type=column_type))
+        logger.info('Column {name} added'.format(name=get_ch_field_name(field)))
+    if missing:
+        invalidate_schema_cache()
+
+
+def get_join_keys(source):
+    '''Returns columns identifying rows of source table'''
+    columns = get_table_columns(source)
+    return [get_ch_field_name(field) for field in KEY_FIELDS[source]
+            if (get_ch_field_name(field) in columns) and (get_ch_field_name(field) != 'Date')]
+
+
+def get_columns_table_name(source, request_id, with_db=True):
+    '''Returns name of table with added columns of Logs API request'''
+    return '{table}_columns_{request_id}'.format(
+        table=get_source_table_name(source, with_db=with_db),
+        request_id=request_id)
+
+
+def create_columns_table(source, request_id, fields):
+    '''Creates table with values of fields of Logs API request by keys of rows.
+    Join engine keeps the first row of a key, so retried parts don't duplicate values'''
+    ch_field_types = utils.get_ch_fields_config()
+    get_clickhouse_data('''
+        CREATE TABLE IF NOT EXISTS {table} (
+            {fields}
+        ) ENGINE = Join(ANY, LEFT, {keys})
+    '''.format(table=get_columns_table_name(source, request_id),
+               keys=', '.join(get_join_keys(source)),
+               fields=',\n'.join(sorted('{name} {type}'.format(
+                   name=get_ch_field_name(field), type=ch_field_types[field])
+                   for field in fields))))
+
+
+def wait_for_mutations(source, delay=1):
+    '''Waits until mutations of source table are done'''
+    query = '''
+        SELECT mutation_id, latest_fail_reason
+        FROM system.mutations
+        WHERE database = '{db}' AND table = '{table}' AND NOT is_done
+    '''.format(db=get_settings().database, table=get_source_table_name(source, with_db=False))
+    while True:
+        mutations = get_clickhouse_data(query).strip()
+        if not mutations:
+            return
+        for mutation in mutations.split('\n'):
+            mutation_id, reason = (mutation.split('\t') + [''])[:2]
+            if reason:
+                raise RuntimeError('Mutation {mutation_id} of {table} failed: {reason}'.format(
+                    mutation_id=mutation_id, table=get_source_table_name(source),
+                    reason=reason))
+        time.sleep(delay)
+
+
+def update_columns(source, request_id, fields, start_date_str, end_date_str,
+                   counter_id=None):
+    '''Fills columns of rows loaded for the period (and counter) with values
+    from table of Logs API request and drops it. Only updated columns are
+    rewritten by the mutation'''
+    columns_table = get_columns_table_name(source, request_id)
+    keys = get_join_keys(source)
+    columns = [get_ch_field_name(field) for field in fields
+               if field not in KEY_FIELDS[source]]
+    condition = "Date >= '{start_date}' AND Date <= '{end_date}'".format(
+        start_date=start_date_str, end_date=end_date_str)
+    if (counter_id is not None) and ('CounterID' in get_table_columns(source)):
+        condition += ' AND CounterID = {counter_id}'.format(counter_id=int(counter_id))
+    if columns:
+        get_clickhouse_data('''
+            ALTER TABLE {table}
+            UPDATE {updates}
+            WHERE {condition}
+        '''.format(table=get_source_table_name(source), condition=condition,
+                   updates=',\n'.join("{column} = joinGet('{columns_table}', '{column}', {keys})".format(
+                       column=column, columns_table=columns_table, keys=', '.join(keys))
+                       for column in columns)),
+            settings={'allow_nondeterministic_mutations': 1}, retries=0)
+        # Values are read from the table while mutation runs
+        wait_for_mutations(source)
+        logger.info('Columns {columns} of {table} updated'.format(
+            columns=', '.join(columns), table=get_source_table_name(source)))
+    get_clickhouse_data('DROP TABLE IF EXISTS {table}'.format(table=columns_table))
@@ -0,0 +1,58 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = ['none', 'gzip', 'deflate', 'zstd']
+
+
+def validate_codec(codec):
+    '''Checks that codec is known and can be used'''
+    assert codec in CODECS, 'Unknown compression: {codec}'.format(codec=codec)
+    if (codec == 'zstd') and (zstandard is None):
+        raise RuntimeError('zstd compression requires zstandard library: '
+                           'pip install zstandard')
+
+
+def get_compressor(codec, level=None):
+    '''Returns object with compress() and flush() methods for codec'''
+    validate_codec(codec)
+    if codec == 'gzip':
+        return zlib.compressobj(1 if level is None else level,
+                                zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if codec == 'deflate':
+        return zlib.compressobj(1 if level is None else level)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3 if level is None else level) \
+            .compressobj()
+
+
+def get_decompressor(codec):
+    '''Returns object with decompress() method for codec'''
+    validate_codec(codec)
+    if codec == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if codec == 'deflate':
+        return zlib.decompressobj()
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+def compress_stream(chunks, codec, level=None):
+    '''Yields compressed data for iterable of byte chunks'''
+    if codec == 'none':
+        for chunk in chunks:
+            yield chunk
+        return
+
+    compressor = get_compressor(codec, level)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
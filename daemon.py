@@ -0,0 +1,242 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+from multiprocessing.pool import ThreadPool
+import clickhouse
+import datetime
+import json
+import logging
+import metrics
+import request_manager
+import sinks
+import threading
+import time
+import utils
+
+if utils.get_python_version().startswith('2'):
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+logger = logging.getLogger('logs_api')
+
+
+class StatusServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    '''Serves status of daemon as JSON at / and metrics
+    of the last cycle in Prometheus text format at /metrics'''
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            body = self.server.owner.get_metrics().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path.split('?')[0] in ['/', '/status']:
+            body = json.dumps(self.server.owner.get_status(), indent=2,
+                              sort_keys=True).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def get_job_key(user_request):
+    return '{counter_id}|{source}'.format(counter_id=user_request.counter_id,
+                                          source=user_request.source)
+
+
+def get_day_end(date_str):
+    '''Returns timestamp of the end of day (local time), when its data
+    may become available in Logs API'''
+    date = datetime.datetime.strptime(date_str, utils.DATE_FORMAT) + datetime.timedelta(1)
+    return time.mktime(date.timetuple())
+
+
+class Daemon(object):
+    '''Keeps loading data of jobs: every cycle (each interval secs) each job
+    gets days from lookback_days ago up to delay_days ago which are missing
+    in sink, so the new day is loaded as soon as its data is complete
+    (delay_days after it) and days missed by failed cycles are refilled. Connections and
+    schema caches stay warm between cycles.
+
+    run_job and save_report are functions of the script running a job
+    and saving report of a cycle'''
+
+    def __init__(self, config, user_requests, run_job, save_report, state_store):
+        self.config = config
+        self.settings = config['daemon']
+        self.user_requests = user_requests
+        self.run_job = run_job
+        self.save_report = save_report
+        self.state_store = state_store
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.cycles = 0
+        self.queue = []
+        self.running = []
+        self.last_cycle = None
+        self.next_cycle_at = None
+        self.report = None
+        self.jobs = dict((get_job_key(user_request), {
+            'counter_id': user_request.counter_id,
+            'source': user_request.source,
+            'status': 'new',
+            'last_date': None,
+            'latency_seconds': None
+        }) for user_request in user_requests)
+        self.server = None
+
+    def validate(self):
+        '''Checks that sink can tell which days are loaded'''
+        for user_request in self.user_requests:
+            assert any(clickhouse.get_ch_field_name(field) == 'Date'
+                       for field in user_request.fields), \
+                'Daemon mode requires date field for {source} of counter {counter_id}' \
+                .format(source=user_request.source, counter_id=user_request.counter_id)
+
+    def get_period(self):
+        '''Returns period which should be loaded at the moment'''
+        today = datetime.datetime.today()
+        return ((today - datetime.timedelta(self.settings['lookback_days']))
+                .strftime(utils.DATE_FORMAT),
+                (today - datetime.timedelta(self.settings['delay_days']))
+                .strftime(utils.DATE_FORMAT))
+
+    def start_server(self):
+        '''Starts status endpoint in background thread'''
+        if not self.settings['status_port']:
+            return
+        self.server = StatusServer((self.settings['status_host'],
+                                    self.settings['status_port']), StatusHandler)
+        self.server.owner = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logger.info('Status is served at http://{host}:{port}/'.format(
+            host=self.settings['status_host'], port=self.server.server_address[1]))
+
+    def run(self):
+        '''Runs cycles until stopped'''
+        self.validate()
+        self.start_server()
+        try:
+            while not self.stopped.is_set():
+                start_time = time.time()
+                try:
+                    self.run_cycle()
+                except Exception as e:
+                    logger.exception(e)
+                with self.lock:
+                    self.next_cycle_at = start_time + self.settings['interval']
+                self.stopped.wait(max(0, self.next_cycle_at - time.time()))
+        finally:
+            if self.server is not None:
+                self.server.shutdown()
+                self.server.server_close()
+        logger.info('### DAEMON STOPPED')
+
+    def stop(self):
+        '''Makes daemon stop after the current cycle'''
+        self.stopped.set()
+
+    def run_cycle(self):
+        '''Loads missing days of all jobs and saves report of the cycle'''
+        start_date_str, end_date_str = self.get_period()
+        logger.info('### CYCLE {cycle}: {start} - {end}'.format(
+            cycle=self.cycles + 1, start=start_date_str, end=end_date_str))
+        metrics.reset()
+        request_manager.reset()
+        user_requests = [user_request._replace(start_date_str=start_date_str,
+                                               end_date_str=end_date_str)
+                         for user_request in self.user_requests]
+        with self.lock:
+            self.queue = list(user_requests)
+            self.next_cycle_at = None
+        start_time = time.time()
+
+        workers = min(self.config['max_parallel_jobs'], len(user_requests))
+        pool = ThreadPool(max(workers, 1))
+        try:
+            results = pool.map(self.run_queued_job, user_requests)
+        finally:
+            pool.close()
+            pool.join()
+
+        if any(result.status == 'failed' for result in results):
+            # Tables might have been changed, so schema is checked again
+            clickhouse.invalidate_schema_cache()
+        report = metrics.get_report(results)
+        self.save_report(self.config, results, report)
+        with self.lock:
+            self.cycles += 1
+            self.report = report
+            self.last_cycle = {
+                'started_at': int(start_time),
+                'seconds': round(time.time() - start_time, 3),
+                'period': [start_date_str, end_date_str],
+                'failed_jobs': sum(result.status == 'failed' for result in results)
+            }
+
+    def run_queued_job(self, user_request):
+        '''Runs job taken from queue and updates its status'''
+        with self.lock:
+            self.queue.remove(user_request)
+            self.running.append(user_request)
+        try:
+            result = self.run_job(self.config, user_request, self.state_store)
+            loaded_dates = None
+            if result.status != 'failed':
+                try:
+                    loaded_dates = sinks.get_sink(self.config).get_loaded_dates(user_request)
+                except Exception as e:
+                    logger.warning('Loaded dates are unknown: {e}'.format(e=e))
+        finally:
+            with self.lock:
+                self.running.remove(user_request)
+        self.update_job(user_request, result, loaded_dates)
+        return result
+
+    def update_job(self, user_request, result, loaded_dates):
+        '''Records result of job and latency of its newest day: time since
+        the end of the day until its data was loaded'''
+        with self.lock:
+            job = self.jobs[get_job_key(user_request)]
+            job.update(status=result.status, error=result.error,
+                       seconds=result.seconds, finished_at=int(time.time()))
+            if loaded_dates:
+                last_date = max(loaded_dates)
+                if last_date != job['last_date']:
+                    job['last_date'] = last_date
+                    job['latency_seconds'] = int(time.time() - get_day_end(last_date))
+
+    def get_status(self):
+        with self.lock:
+            return {
+                'started_at': int(self.started_at),
+                'state': 'running' if self.running or self.queue else 'waiting',
+                'cycles': self.cycles,
+                'queue_depth': len(self.queue),
+                'running_jobs': len(self.running),
+                'last_cycle': self.last_cycle,
+                'next_cycle_at': int(self.next_cycle_at) if self.next_cycle_at else None,
+                'jobs': sorted(self.jobs.values(),
+                               key=lambda job: (job['counter_id'], job['source']))
+            }
+
+    def get_metrics(self):
+        with self.lock:
+            report = self.report
+        return metrics.get_prometheus(report) if report is not None else ''
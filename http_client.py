@@ -0,0 +1,241 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import email.utils
+import logging
+import metrics
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_SETTINGS = {
+    'pool_size': 10,
+    'connect_timeout': 10,
+    'read_timeout': 300,
+    'retries': 3,
+    'retries_backoff': 0.5,
+    'call_retries': 5,
+    'call_retries_backoff': 1,
+    'call_retries_max_delay': 60,
+    'rate_limits': {}
+}
+
+# Statuses meaning that server (or proxy in front of it) is overloaded
+# or unavailable, so the request may succeed later
+TRANSIENT_STATUSES = [429, 502, 503, 504]
+
+# Statuses meaning that server refused the request without processing it,
+# so it's safe to repeat it for any method. A gateway error (502, 504)
+# doesn't mean the upstream did nothing, so only GET is repeated after it
+REFUSED_STATUSES = [429, 503]
+
+logger = logging.getLogger('logs_api')
+
+_settings = dict(DEFAULT_SETTINGS)
+_clients = {}
+_lock = threading.Lock()
+
+
+class HttpError(ValueError):
+    '''Request failed with HTTP status, message is the response body'''
+
+    def __init__(self, status_code, text):
+        super(HttpError, self).__init__('HTTP {status}: {text}'.format(
+            status=status_code, text=text))
+        self.status_code = status_code
+        self.text = text
+
+
+class TransientError(HttpError):
+    '''Server is overloaded or unavailable, the request may succeed later'''
+
+
+class RateLimitError(TransientError):
+    '''Server asked to slow down (429), retry_after is its delay in secs or None'''
+
+    def __init__(self, status_code, text, retry_after=None):
+        super(RateLimitError, self).__init__(status_code, text)
+        self.retry_after = retry_after
+
+
+class PermanentError(HttpError):
+    '''Request is rejected (wrong parameters, token, query) and repeating won't help'''
+
+
+def get_retry_after(response):
+    '''Returns delay in secs from Retry-After header of response or None'''
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+def raise_error(response):
+    '''Raises error of class matching status of failed response'''
+    if response.status_code == 429:
+        raise RateLimitError(response.status_code, response.text,
+                             get_retry_after(response))
+    if (response.status_code in TRANSIENT_STATUSES) or (response.status_code >= 500):
+        raise TransientError(response.status_code, response.text)
+    raise PermanentError(response.status_code, response.text)
+
+
+class TokenBucket(object):
+    '''Limits rate of requests shared by all threads: up to burst requests
+    at once and rate requests per second on average'''
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Takes a token waiting until one is available, returns seconds waited'''
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            self.sleep(delay)
+            waited += delay
+
+
+class HttpClient(object):
+    '''Keep-alive HTTP session with pool of connections and default timeouts.
+
+    Calls are retried with jittered exponential backoff when server refused
+    them (see REFUSED_STATUSES), GET calls also when it is overloaded
+    (see TRANSIENT_STATUSES) and on network errors.
+    Retry-After of 429 responses pauses all calls of the client, so parallel
+    workers slow down together, and rate_limit (requests per sec) is shared
+    by all of them as well'''
+
+    def __init__(self, pool_size=10, connect_timeout=10, read_timeout=300,
+                 retries=3, retries_backoff=0.5, call_retries=5,
+                 call_retries_backoff=1, call_retries_max_delay=60, rate_limit=0):
+        self.timeout = (connect_timeout, read_timeout)
+        self.call_retries = call_retries
+        self.call_retries_backoff = call_retries_backoff
+        self.call_retries_max_delay = call_retries_max_delay
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.paused_until = 0
+        # Only failed connections are retried here: they are safe to repeat
+        # for any method, as the request never reached the server
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=retries, connect=retries, read=0,
+                              status=0, backoff_factor=retries_backoff,
+                              respect_retry_after_header=False)
+        )
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get_delay(self, attempt, retry_after=None):
+        '''Returns delay before retry: server's Retry-After if any,
+        otherwise random one up to exponentially growing limit'''
+        if retry_after is not None:
+            return min(retry_after, self.call_retries_max_delay)
+        return random.uniform(0, min(self.call_retries_max_delay,
+                                     self.call_retries_backoff * 2 ** attempt))
+
+    def wait(self):
+        '''Waits for pause requested by server and for rate limit'''
+        delay = self.paused_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        if self.bucket is not None:
+            waited = self.bucket.acquire()
+            if waited > 0:
+                metrics.record('throttle', waited)
+
+    def request(self, method, url, retries=None, **kwargs):
+        '''Sends request retrying it up to retries times (call_retries
+        by default) while it fails transiently. Body must be repeatable
+        (not an iterator) unless retries is 0. The last response is returned,
+        whatever status it has'''
+        kwargs.setdefault('timeout', self.timeout)
+        if retries is None:
+            retries = self.call_retries
+        statuses = TRANSIENT_STATUSES if method == 'GET' else REFUSED_STATUSES
+        attempt = 0
+        while True:
+            self.wait()
+            try:
+                response = self.account(self.session.request(method, url, **kwargs))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # The server might have processed POST, so only GET is repeated
+                if (method != 'GET') or (attempt >= retries):
+                    raise
+                delay = self.get_delay(attempt)
+                logger.warning('{method} failed: {e}, retrying in {delay:.1f} secs'.format(
+                    method=method, e=e, delay=delay))
+            else:
+                if (response.status_code not in statuses) or (attempt >= retries):
+                    return response
+                retry_after = get_retry_after(response)
+                delay = self.get_delay(attempt, retry_after)
+                if response.status_code == 429:
+                    metrics.increment('http_rate_limited')
+                    self.paused_until = max(self.paused_until, time.time() + delay)
+                logger.warning('{method} returned {status}, retrying in {delay:.1f} secs'.format(
+                    method=method, status=response.status_code, delay=delay))
+                response.close()
+            metrics.increment('http_retries')
+            time.sleep(delay)
+            attempt += 1
+
+    def account(self, response):
+        '''Accounts request and its retries in metrics of the run'''
+        retries = getattr(response.raw, 'retries', None)
+        metrics.increment('http_requests')
+        if retries is not None:
+            metrics.increment('http_retries', len(retries.history))
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+def configure(config):
+    '''Applies HTTP settings from user config to clients created afterwards'''
+    with _lock:
+        _settings.update(config.get('http', {}))
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def get_client(name):
+    '''Returns shared client for a service (e.g. metrika or clickhouse)'''
+    with _lock:
+        if name not in _clients:
+            settings = dict(_settings)
+            rate_limits = settings.pop('rate_limits')
+            _clients[name] = HttpClient(rate_limit=rate_limits.get(name, 0), **settings)
+        return _clients[name]
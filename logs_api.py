@@ -1,13 +1,18 @@
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
-import requests
-
 import json
 import utils
 import clickhouse
-import datetime
+import http_client
+import itertools
 import logging
+import metrics
+import os
+import sinks
+import streams
+import time
+import tsv
 
 if utils.get_python_version().startswith('2'):
     from urllib import urlencode
@@ -36,58 +41,31 @@ def get_estimation(user_request):
     url = '{host}/management/v1/counter/{counter_id}/logrequests/evaluate?'\
         .format(host=HOST, counter_id=user_request.counter_id) + url_params
 
-    r = requests.get(url, headers=headers)
+    with metrics.timer('evaluate'):
+        r = http_client.get_client('metrika').get(url, headers=headers)
 
     if r.status_code == 200:
         return json.loads(r.text)['log_request_evaluation']
     else:
-        raise ValueError(r)
-
-
-def get_api_requests(user_request):
-    '''Returns list of API requests for UserRequest'''
-    api_requests = []
-    estimation = get_estimation(user_request)
-    if estimation['possible']:
-        api_request = utils.Structure(
-            user_request=user_request,
-            date1_str=user_request.start_date_str,
-            date2_str=user_request.end_date_str,
-            status='new'
-        )
-        api_requests.append(api_request)
-    elif estimation['max_possible_day_quantity'] != 0:
-        start_date = datetime.datetime.strptime(
-            user_request.start_date_str,
-            utils.DATE_FORMAT
-        )
+        http_client.raise_error(r)
 
-        end_date = datetime.datetime.strptime(
-            user_request.end_date_str,
-            utils.DATE_FORMAT
-        )
 
-        days = (end_date - start_date).days
-        num_requests = int(days/estimation['max_possible_day_quantity']) + 1
-        days_in_period = int(days/num_requests) + 1
-        for i in range(num_requests):
-            date1 = start_date + datetime.timedelta(i*days_in_period)
-            date2 = min(
-                end_date,
-                start_date + datetime.timedelta((i+1)*days_in_period - 1)
-            )
-
-            api_request = utils.Structure(
-                user_request=user_request,
-                date1_str=date1.strftime(utils.DATE_FORMAT),
-                date2_str=date2.strftime(utils.DATE_FORMAT),
-                status='new'
-            )
-            api_requests.append(api_request)
+def get_requests(user_request):
+    '''Returns Logs API requests of counter of UserRequest'''
+    url = '{host}/management/v1/counter/{counter_id}/logrequests' \
+        .format(host=HOST, counter_id=user_request.counter_id)
+
+    headers = {'Authorization': 'OAuth ' + user_request.token}
+
+    with metrics.timer('list'):
+        r = http_client.get_client('metrika').get(url, headers=headers)
+    logger.debug(r.text)
+    if r.status_code == 200:
+        return json.loads(r.text)['requests']
     else:
-        raise RuntimeError('Logs API can\'t load data: max_possible_day_quantity = 0')
-    return api_requests
-  
+        http_client.raise_error(r)
+
+
 def create_task(api_request):
     '''Creates a Logs API task to generate data'''
     url_params = urlencode(
@@ -106,7 +84,8 @@ def create_task(api_request):
 
     headers = {'Authorization': 'OAuth ' + api_request.user_request.token}
 
-    r = requests.post(url, headers=headers)
+    with metrics.timer('create'):
+        r = http_client.get_client('metrika').post(url, headers=headers)
     logger.debug(r.text)
     if r.status_code == 200:
         logger.debug(json.dumps(json.loads(r.text)['log_request'], indent=2))
@@ -116,7 +95,7 @@ def create_task(api_request):
         # api_request.size = response['size']
         return response
     else:
-        raise ValueError(r.text)
+        http_client.raise_error(r)
 
 
 def update_status(api_request):
@@ -128,21 +107,30 @@ def update_status(api_request):
 
     headers = {'Authorization': 'OAuth ' + api_request.user_request.token}
 
-    r = requests.get(url, headers=headers)
+    with metrics.timer('status'):
+        r = http_client.get_client('metrika').get(url, headers=headers)
     logger.debug(r.text)
     if r.status_code == 200:
         status = json.loads(r.text)['log_request']['status']
         api_request.status = status
         if status == 'processed':
-            size = len(json.loads(r.text)['log_request']['parts'])
-            api_request.size = size
+            parts = json.loads(r.text)['log_request']['parts']
+            api_request.size = len(parts)
+            api_request.data_size = sum(part.get('size', 0) for part in parts)
         return api_request
     else:
-        raise ValueError(r.text)
-
-
-def save_data(api_request, part):
-    '''Loads data chunk from Logs API and saves to ClickHouse'''
+        http_client.raise_error(r)
+
+
+def save_data(api_request, part, buffer_size=1048576, compression='gzip',
+              rejected_dir=None, sink=None, queue_size=0):
+    '''Streams data chunk from Logs API to sink
+    (ClickHouse table for source of request by default).
+    With gzip compression the part is transferred compressed
+    and decompressed incrementally while reading. Rows with wrong number
+    of columns are written to rejected_dir if it is set.
+    With queue_size download and parsing run in background thread ahead
+    of insert by up to queue_size bytes of blocks'''
     url = '{host}/management/v1/counter/{counter_id}/logrequest/{request_id}/part/{part}/download' \
         .format(
             host=HOST,
@@ -151,35 +139,80 @@ def save_data(api_request, part):
             part=part
         )
 
-    headers = {'Authorization': 'OAuth ' + api_request.user_request.token}
+    headers = {
+        'Authorization': 'OAuth ' + api_request.user_request.token,
+        'Accept-Encoding': 'gzip' if compression == 'gzip' else 'identity'
+    }
 
-    r = requests.get(url, headers=headers)
+    start_time = time.time()
+    r = http_client.get_client('metrika').get(url, headers=headers, stream=True)
     if r.status_code != 200:
         logger.debug(r.text)
-        raise ValueError(r.text)
-
-
-
-    splitted_text = r.text.split('\n')
-    logger.info('### DATA SAMPLE')
-    logger.info('\n'.join(splitted_text[:5]))
-
-    headers_num = len(splitted_text[0].split('\t'))
-    splitted_text_filtered = list(filter(lambda x: len(x.split('\t')) == headers_num, r.text.split('\n')))
-    num_filtered = len(splitted_text) - len(splitted_text_filtered)
-    if num_filtered != 0:
-        logger.warning('%d rows were filtered out' % num_filtered)
-    
-    if len(splitted_text_filtered) > 1:
-        output_data = '\n'.join(splitted_text_filtered[1:]) #.encode('utf-8')
-        output_data = '\t'.join(map(clickhouse.get_ch_field_name, splitted_text_filtered[0].split('\t'))) + '\n' + output_data # convert headers to CH column names
-        output_data = output_data.replace(r"\'", "'") # to correct escapes in params
-
-        clickhouse.save_data(api_request.user_request.source,
-                             api_request.user_request.fields,
-                             output_data)
-    else:
-        logger.warning('### No data to upload')
+        http_client.raise_error(r)
+
+    # Time of download and parsing is measured while the stream is consumed,
+    # the rest of time of the part is spent on inserting
+    download = metrics.StreamStats()
+    parse = metrics.StreamStats(download)
+    transformer = None
+    prefetcher = None
+    try:
+        blocks = download.wrap(tsv.iter_blocks(r.iter_content(chunk_size=buffer_size)))
+        first_block = next(blocks, b'')
+        logger.info('### DATA SAMPLE')
+        logger.info(b'\n'.join(first_block.split(b'\n', 5)[:5]).decode('utf-8', 'replace'))
+
+        header, blocks = tsv.split_header(itertools.chain([first_block], blocks))
+        if not header:
+            logger.warning('### No data to upload')
+            api_request.status = 'saved'
+            return
+
+        rejected_path = None
+        if rejected_dir:
+            rejected_path = os.path.join(rejected_dir, '{counter_id}_{request_id}_{part}.tsv'.format(
+                counter_id=api_request.user_request.counter_id,
+                request_id=api_request.request_id,
+                part=part))
+        transformer = tsv.RowsTransformer(header, rejected_path)
+        rows = parse.wrap(transformer.transform_blocks(blocks))
+        if queue_size:
+            prefetcher = streams.Prefetcher(rows, queue_size)
+            rows = iter(prefetcher)
+
+        # Peek the first block to avoid creating empty inserts
+        insert_start_time = time.time()
+        first_rows = next(rows, None)
+        if first_rows is not None:
+            header = clickhouse.get_ch_header(header)
+            sink = sink or sinks.ClickHouseSink()
+            sink.save_part(api_request, part, header,
+                           itertools.chain([first_rows], rows))
+        else:
+            logger.warning('### No data to upload')
+
+        insert, queue = None, None
+        if prefetcher is not None:
+            # Download runs at the same time, so insert is the time
+            # it didn't wait for blocks
+            prefetcher.join()
+            queue = prefetcher.queue.get_stats()
+            insert = time.time() - insert_start_time - queue['get_wait']
+        if transformer.rejected != 0:
+            logger.warning('%d rows were filtered out' % transformer.rejected)
+        metrics.record_part(api_request, part, time.time() - start_time,
+                            download, parse, transformer.rows, transformer.rejected,
+                            insert, queue)
+    finally:
+        # Closing the response interrupts download waiting for data,
+        # so background thread is done before rows are closed
+        if prefetcher is not None:
+            prefetcher.stop()
+        r.close()
+        if prefetcher is not None:
+            prefetcher.join()
+        if transformer is not None:
+            transformer.close()
 
     api_request.status = 'saved'
 
@@ -192,10 +225,11 @@ def clean_data(api_request):
 
     headers = {'Authorization': 'OAuth ' + api_request.user_request.token}
 
-    r = requests.post(url, headers=headers)
+    with metrics.timer('clean'):
+        r = http_client.get_client('metrika').post(url, headers=headers)
     logger.debug(r.text)
     if r.status_code != 200:
-        raise ValueError(r.text)
+        http_client.raise_error(r)
 
     api_request.status = json.loads(r.text)['log_request']['status']
     return json.loads(r.text)['log_request']
@@ -1,7 +1,14 @@
 from collections import namedtuple
-import logs_api
-import time
+from multiprocessing.pool import ThreadPool
 import clickhouse
+import daemon
+import http_client
+import metrics
+import scheduler
+import signal
+import sinks
+import state
+import time
 import utils
 import sys
 import datetime
@@ -17,12 +24,13 @@ def setup_logging(config):
                         datefmt='%Y-%m-%d %H:%M:%S', )
 
 
-def get_date_period(options):
+def get_date_period(options, counter_id, token):
     if options.mode is None:
         start_date_str = options.start_date
         end_date_str = options.end_date
     else:
-        if options.mode == 'regular':
+        if options.mode in ['regular', 'daemon']:
+            # daemon moves period of jobs every cycle
             start_date_str = (datetime.datetime.today() - datetime.timedelta(2)) \
                 .strftime(utils.DATE_FORMAT)
             end_date_str = (datetime.datetime.today() - datetime.timedelta(2)) \
@@ -33,26 +41,30 @@ def get_date_period(options):
             end_date_str = (datetime.datetime.today() - datetime.timedelta(1)) \
                 .strftime(utils.DATE_FORMAT)
         elif options.mode == 'history':
-            start_date_str = utils.get_counter_creation_date(
-                config['counter_id'],
-                config['token']
-            )
+            start_date_str = utils.get_counter_creation_date(counter_id, token)
             end_date_str = (datetime.datetime.today() - datetime.timedelta(2)) \
                 .strftime(utils.DATE_FORMAT)
     return start_date_str, end_date_str
 
 
-def build_user_request(config):
-    options = utils.get_cli_options()
-    logger.info('CLI Options: ' + str(options))
+def build_user_request(config, options, job=None):
+    '''Returns UserRequest for a job (counter and source) from config
+    or for the one specified in CLI options'''
+    if job is None:
+        job = {'source': options.source}
+    counter_id = job.get('counter_id', config['counter_id'])
+    token = job.get('token', config['token'])
+    source = job['source']
 
-    start_date_str, end_date_str = get_date_period(options)
-    source = options.source
+    start_date_str, end_date_str = get_date_period(options, counter_id, token)
 
     # Validate that fields are present in config
-    assert '{source}_fields'.format(source=source) in config, \
+    assert ('fields' in job) or ('{source}_fields'.format(source=source) in config), \
         'Fields must be specified in config'
-    fields = config['{source}_fields'.format(source=source)]
+    fields = job.get('fields') or config['{source}_fields'.format(source=source)]
+    if options.add_fields:
+        # Only the new fields are requested along with keys of rows
+        fields = sinks.ColumnsSink.get_fields(source, options.add_fields.split(','))
 
     # Creating data structure (immutable tuple) with initial user request
     UserRequest = namedtuple(
@@ -61,8 +73,8 @@ def build_user_request(config):
     )
 
     user_request = UserRequest(
-        token=config['token'],
-        counter_id=config['counter_id'],
+        token=token,
+        counter_id=counter_id,
         start_date_str=start_date_str,
         end_date_str=end_date_str,
         source=source,
@@ -74,58 +86,144 @@ def build_user_request(config):
     return user_request
 
 
-def integrate_with_logs_api(config, user_request):
+def build_user_requests(config, options):
+    '''Returns UserRequests for all jobs to run'''
+    if not options.jobs:
+        return [build_user_request(config, options)]
+    assert config['jobs'], 'Jobs must be specified in config'
+    return [build_user_request(config, options, job) for job in config['jobs']]
+
+
+def integrate_with_logs_api(config, user_request, state_store, reload=False):
     for i in range(config['retries']):
         time.sleep(i * config['retries_delay'])
         try:
-            # Creating API requests
-            api_requests = logs_api.get_api_requests(user_request)
-
-            for api_request in api_requests:
-                logger.info('### CREATING TASK')
-                logs_api.create_task(api_request)
-                print(api_request)
-
-                delay = 20
-                while api_request.status != 'processed':
-                    logger.info('### DELAY %d secs' % delay)
-                    time.sleep(delay)
-                    logger.info('### CHECKING STATUS')
-                    api_request = logs_api.update_status(api_request)
-                    logger.info('API Request status: ' + api_request.status)
-
-                logger.info('### SAVING DATA')
-                for part in range(api_request.size):
-                    logger.info('Part #' + str(part))
-                    logs_api.save_data(api_request, part)
-
-                logger.info('### CLEANING DATA')
-                logs_api.clean_data(api_request)
+            # Checking schema before any data is requested
+            sinks.get_sink(config).prepare(user_request)
+
+            # Creating API requests or resuming unfinished ones
+            api_requests = scheduler.get_api_requests(config, user_request,
+                                                      state_store, reload)
+
+            scheduler.process_api_requests(config, api_requests, state_store)
         except Exception as e:
             logger.critical('Iteration #{i} failed'.format(i=i + 1))
             logger.critical(e);
-            if i == config['retries'] - 1:
+            # Transient errors are already retried by every call and part,
+            # rejected requests and partly saved parts fail the same way
+            # on every iteration
+            if isinstance(e, (http_client.PermanentError, sinks.PartlySavedError)) \
+                    or (i == config['retries'] - 1):
                 raise e
 
+def save_report(config, results, report):
+    '''Logs summary of stages and writes report files of the run'''
+    logger.info('### STAGES')
+    for line in metrics.get_summary(report):
+        logger.info(line)
+    if config['report_file']:
+        metrics.write_report(config['report_file'], report)
+    if config['prometheus_file']:
+        metrics.write_prometheus(config['prometheus_file'], report)
+
+
+def run_daemon(config, user_requests, state_store):
+    '''Runs jobs continuously until the process is terminated'''
+    service = daemon.Daemon(config, user_requests, run_job, save_report, state_store)
+
+    def stop(signum, frame):
+        logger.info('### STOPPING DAEMON AFTER CURRENT CYCLE')
+        service.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    service.run()
+
+
+def run_job(config, user_request, state_store, reload=False):
+    '''Loads data for a single user request and returns its summary'''
+    start_time = time.time()
+    result = utils.Structure(counter_id=user_request.counter_id,
+                             source=user_request.source,
+                             status='done',
+                             error=None)
+    try:
+        # If data for every day of period is already saved, job is skipped
+        sinks.get_sink(config).prepare(user_request)
+        if not reload and \
+                not scheduler.get_missing_date_ranges(config, user_request, state_store):
+            logger.critical('Data for selected dates is already saved: '
+                            'counter {counter_id}, {source}'.format(
+                                counter_id=user_request.counter_id,
+                                source=user_request.source))
+            result.status = 'skipped'
+        else:
+            integrate_with_logs_api(config, user_request, state_store, reload)
+    except Exception as e:
+        logger.exception(e)
+        result.status = 'failed'
+        result.error = str(e)
+    result.seconds = int(time.time() - start_time)
+    return result
+
+
+def run_jobs(config, user_requests, state_store, reload=False):
+    '''Runs jobs at most max_parallel_jobs at once and logs their summary.
+    Jobs share HTTP connection pools and Logs API quotas of tokens'''
+    workers = min(config['max_parallel_jobs'], len(user_requests))
+    if workers <= 1:
+        results = [run_job(config, user_request, state_store, reload)
+                   for user_request in user_requests]
+    else:
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(
+                lambda user_request: run_job(config, user_request, state_store, reload),
+                user_requests)
+        finally:
+            pool.close()
+            pool.join()
+
+    logger.info('### JOBS SUMMARY')
+    for result in results:
+        logger.info('{counter_id:>12} {source:<7} {status:<8} {seconds:>6} secs {error}'.format(
+            counter_id=result.counter_id,
+            source=result.source,
+            status=result.status,
+            seconds=result.seconds,
+            error=result.error or ''))
+    return results
+
 if __name__ == '__main__':
     print('##### python', utils.get_python_version())
     start_time = time.time()
 
     config = utils.get_config()
     setup_logging(config)
+    http_client.configure(config)
+    clickhouse.configure(config)
 
-    user_request = build_user_request(config)
-
+    options = utils.get_cli_options()
+    logger.info('CLI Options: ' + str(options))
 
-    # If data for specified period is already in database, script is skipped
-    if clickhouse.is_data_present(user_request.start_date_str,
-                                  user_request.end_date_str,
-                                  user_request.source):
-        logging.critical('Data for selected dates is already in database')
+    user_requests = build_user_requests(config, options)
+    state_store = state.StateStore(config['state_file'])
+
+    assert (not options.reload) or ((config['sink'] == 'clickhouse') and
+                                    (config['clickhouse']['load_mode'] == 'staging')), \
+        'Data can be reloaded only into ClickHouse in staging load mode'
+    if options.add_fields:
+        assert (config['sink'] == 'clickhouse') and (options.mode != 'daemon') \
+            and not options.reload, \
+            'Fields can be added only to ClickHouse tables, not in daemon or reload modes'
+        config['sink'] = 'columns'
+    if options.mode == 'daemon':
+        assert not options.reload, 'Data can\'t be reloaded in daemon mode'
+        run_daemon(config, user_requests, state_store)
         exit(0)
 
-
-    integrate_with_logs_api(config, user_request)
+    results = run_jobs(config, user_requests, state_store, options.reload)
+    save_report(config, results, metrics.get_report(results))
 
     end_time = time.time()
     logger.info('### TOTAL TIME: %d minutes %d seconds' % (
@@ -133,3 +231,6 @@ if __name__ == '__main__':
         (end_time - start_time) % 60
     ))
 
+    if any(result.status == 'failed' for result in results):
+        exit(1)
+
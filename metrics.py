@@ -0,0 +1,217 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+MB = 1024.0 * 1024
+
+# Pipeline stages in the order they happen
+STAGES = ['evaluate', 'list', 'create', 'status', 'wait', 'download', 'parse',
+          'insert', 'publish', 'clean', 'throttle', 'queue_full', 'queue_empty']
+
+# Statistics of the run, shared by all jobs and workers
+_lock = threading.Lock()
+_stages = {}
+_counters = {}
+_parts = []
+_started_at = time.time()
+
+
+def reset():
+    '''Starts collecting statistics of a new run'''
+    global _started_at
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        del _parts[:]
+        _started_at = time.time()
+
+
+def record(stage, seconds):
+    '''Accounts a call of stage which took seconds'''
+    with _lock:
+        stats = _stages.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+@contextlib.contextmanager
+def timer(stage):
+    '''Measures time of the block as a call of stage'''
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(stage, time.time() - start)
+
+
+class StreamStats(object):
+    '''Time spent producing items of a wrapped iterator and their size.
+    Time of the inner stream the iterator reads from is excluded,
+    so nested streams are measured separately'''
+
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def wrap(self, iterable):
+        iterator = iter(iterable)
+        while True:
+            inner_seconds = self.inner.seconds if self.inner is not None else 0.0
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.seconds += time.time() - start
+                if self.inner is not None:
+                    self.seconds -= self.inner.seconds - inner_seconds
+            self.bytes += len(item)
+            yield item
+
+
+def record_part(api_request, part, seconds, download, parse, rows, rows_filtered,
+                insert=None, queue=None):
+    '''Accounts a saved part: time of the whole part is split into
+    download, parse and insert (the rest, unless measured) stages.
+    Stats of queue between download and insert add time download waited
+    for room in it (queue_full) and insert waited for data (queue_empty)'''
+    if insert is None:
+        insert = seconds - download.seconds - parse.seconds
+    record('download', download.seconds)
+    record('parse', parse.seconds)
+    record('insert', insert)
+    if queue is not None:
+        record('queue_full', queue['put_wait'])
+        record('queue_empty', queue['get_wait'])
+    with _lock:
+        for name, value in [('parts', 1), ('bytes_downloaded', download.bytes),
+                            ('bytes_inserted', parse.bytes), ('rows', rows),
+                            ('rows_filtered', rows_filtered)]:
+            _counters[name] = _counters.get(name, 0) + value
+        _parts.append({
+            'counter_id': api_request.user_request.counter_id,
+            'source': api_request.user_request.source,
+            'request_id': api_request.request_id,
+            'part': part,
+            'bytes': download.bytes,
+            'rows': rows,
+            'rows_filtered': rows_filtered,
+            'download_seconds': round(download.seconds, 3),
+            'parse_seconds': round(parse.seconds, 3),
+            'insert_seconds': round(insert, 3)
+        })
+        if queue is not None:
+            _parts[-1].update(queue_max_bytes=queue['max_bytes'],
+                              queue_avg_bytes=queue['avg_bytes'])
+
+
+def get_speed(value, seconds):
+    return round(value / seconds, 2) if seconds > 0 else None
+
+
+def get_report(results=None):
+    '''Returns statistics of the run with summaries of jobs'''
+    with _lock:
+        seconds = time.time() - _started_at
+        stages = dict((stage, {'calls': stats['calls'],
+                               'seconds': round(stats['seconds'], 3),
+                               'max_seconds': round(stats['max_seconds'], 3)})
+                      for stage, stats in _stages.items())
+        counters = dict(_counters)
+        parts = list(_parts)
+
+    def get_seconds(stage):
+        return stages.get(stage, {}).get('seconds', 0.0)
+
+    # Time of parts is summed up over workers, so speeds are per worker
+    return {
+        'started_at': int(_started_at),
+        'seconds': round(seconds, 3),
+        'jobs': [dict(result.__dict__) for result in results or []],
+        'stages': stages,
+        'counters': counters,
+        'throughput': {
+            'download_mb_per_sec': get_speed(counters.get('bytes_downloaded', 0) / MB,
+                                             get_seconds('download')),
+            'insert_mb_per_sec': get_speed(counters.get('bytes_inserted', 0) / MB,
+                                           get_seconds('insert')),
+            'rows_per_sec': get_speed(counters.get('rows', 0), get_seconds('download') +
+                                      get_seconds('parse') + get_seconds('insert')),
+            'rows_per_sec_of_run': get_speed(counters.get('rows', 0), seconds)
+        },
+        'parts': parts
+    }
+
+
+def get_summary(report):
+    '''Returns lines describing time of stages'''
+    lines = []
+    for stage in STAGES:
+        if stage in report['stages']:
+            stats = report['stages'][stage]
+            lines.append('{stage:<9} {calls:>6} calls {seconds:>10.1f} secs '
+                         '(max {max_seconds:.1f})'.format(stage=stage, **stats))
+    return lines
+
+
+def write_file(path, content):
+    '''Replaces file atomically, so readers never see a partial one'''
+    with open(path + '.tmp', 'w') as output_file:
+        output_file.write(content)
+    os.rename(path + '.tmp', path)
+
+
+def write_report(path, report):
+    write_file(path, json.dumps(report, indent=2, sort_keys=True))
+
+
+def get_prometheus(report):
+    '''Returns report in Prometheus text format'''
+    lines = []
+
+    def add(name, kind, help_text, samples):
+        lines.append('# HELP logs_api_{name} {help}'.format(name=name, help=help_text))
+        lines.append('# TYPE logs_api_{name} {kind}'.format(name=name, kind=kind))
+        for labels, value in samples:
+            lines.append('logs_api_{name}{labels} {value}'.format(
+                name=name, value=value,
+                labels='{' + ','.join('{0}="{1}"'.format(*label) for label in labels) + '}'
+                if labels else ''))
+
+    stages = sorted(report['stages'].items())
+    add('stage_seconds', 'gauge', 'Time spent in pipeline stage',
+        [([('stage', stage)], stats['seconds']) for stage, stats in stages])
+    add('stage_calls', 'gauge', 'Number of calls of pipeline stage',
+        [([('stage', stage)], stats['calls']) for stage, stats in stages])
+    add('stage_max_seconds', 'gauge', 'Longest call of pipeline stage',
+        [([('stage', stage)], stats['max_seconds']) for stage, stats in stages])
+    for name, value in sorted(report['counters'].items()):
+        add(name, 'gauge', 'Number of ' + name.replace('_', ' ') + ' in the run',
+            [([], value)])
+    statuses = {}
+    for job in report['jobs']:
+        statuses[job['status']] = statuses.get(job['status'], 0) + 1
+    add('jobs', 'gauge', 'Number of jobs by status',
+        [([('status', status)], count) for status, count in sorted(statuses.items())])
+    add('run_seconds', 'gauge', 'Duration of the run', [([], report['seconds'])])
+    add('run_timestamp_seconds', 'gauge', 'Start time of the run',
+        [([], report['started_at'])])
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, report):
+    '''Writes report in Prometheus text format for textfile collector'''
+    write_file(path, get_prometheus(report))
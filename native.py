@@ -0,0 +1,182 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import datetime
+import itertools
+import re
+import struct
+
+# struct codes of fixed-width types
+FIXED_TYPES = {
+    'UInt8': 'B',
+    'UInt16': 'H',
+    'UInt32': 'I',
+    'UInt64': 'Q',
+    'Int8': 'b',
+    'Int16': 'h',
+    'Int32': 'i',
+    'Int64': 'q',
+    'Float32': 'f',
+    'Float64': 'd'
+}
+
+# Text values are parsed by ClickHouse itself to keep time zone handling
+TEXT_TYPES = {
+    'DateTime': 'String'
+}
+
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+ESCAPES = {
+    b'\\t': b'\t',
+    b'\\n': b'\n',
+    b'\\r': b'\r',
+    b'\\0': b'\0',
+    b'\\b': b'\b',
+    b'\\f': b'\f',
+    b'\\\\': b'\\',
+    b"\\'": b"'",
+    b'\\"': b'"'
+}
+ESCAPE_RE = re.compile(br'\\.')
+QUOTED_RE = re.compile(br"'((?:[^'\\]|\\.)*)'")
+
+
+def encode_varint(n):
+    '''Returns unsigned LEB128 encoding of n'''
+    result = bytearray()
+    while n >= 0x80:
+        result.append((n & 0x7f) | 0x80)
+        n >>= 7
+    result.append(n)
+    return bytes(result)
+
+
+VARINTS = [encode_varint(n) for n in range(16384)]
+
+
+def encode_string(value):
+    '''Returns value prefixed with its length'''
+    n = len(value)
+    return (VARINTS[n] if n < 16384 else encode_varint(n)) + value
+
+
+def unescape(value):
+    '''Returns TSV or quoted value with escape sequences resolved'''
+    if b'\\' not in value:
+        return value
+    return ESCAPE_RE.sub(lambda m: ESCAPES.get(m.group(0), m.group(0)[1:]), value)
+
+
+def get_transfer_type(ch_type):
+    '''Returns type column of ch_type is transferred as'''
+    if ch_type.startswith('Array('):
+        return 'Array({type})'.format(type=get_transfer_type(ch_type[6:-1]))
+    return TEXT_TYPES.get(ch_type, ch_type)
+
+
+def encode_strings(values):
+    '''Returns column data of String values'''
+    lengths = list(map(len, values))
+    if lengths and (max(lengths) >= 16384):
+        return b''.join(map(encode_string, values))
+    return b''.join(itertools.chain.from_iterable(
+        zip(map(VARINTS.__getitem__, lengths), values)))
+
+
+def split_arrays(values, quoted):
+    '''Returns elements of arrays in text format (quoted ones still escaped)
+    and end offset of every array'''
+    offsets = []
+    total = 0
+    if quoted and (b'\\' in b''.join(values)):
+        # escaped quotes may look like separators, so parse literals
+        elements = []
+        for value in values:
+            elements.extend(QUOTED_RE.findall(value))
+            offsets.append(len(elements))
+        return elements, offsets
+
+    strip = 2 if quoted else 1
+    separator = b"','" if quoted else b','
+    items = [value[strip:-strip] for value in values if value != b'[]']
+    for value in values:
+        if value != b'[]':
+            total += value.count(separator) + 1
+        offsets.append(total)
+    elements = separator.join(items).split(separator) if items else []
+    return elements, offsets
+
+
+class ColumnEncoder(object):
+    '''Encodes values of TSV column into ClickHouse Native column data'''
+
+    def __init__(self, ch_type):
+        self.type = get_transfer_type(ch_type)
+        self.dates = {}
+        if self.type.startswith('Array('):
+            self.nested = ColumnEncoder(ch_type[6:-1])
+            self.quoted = self.nested.type in ['String', 'Date']
+        else:
+            assert (self.type in FIXED_TYPES) or (self.type in ['String', 'Date']), \
+                'Unsupported type: ' + ch_type
+
+    def get_day(self, value):
+        '''Returns number of days since epoch for date in text format'''
+        if value not in self.dates:
+            date = datetime.datetime.strptime(value.decode('utf-8'), '%Y-%m-%d')
+            self.dates[value] = date.toordinal() - EPOCH
+        return self.dates[value]
+
+    def encode(self, values):
+        '''Returns column data for list of values in text format'''
+        if self.type in FIXED_TYPES:
+            cast = float if self.type.startswith('Float') else int
+            return struct.pack('<%d%s' % (len(values), FIXED_TYPES[self.type]),
+                               *map(cast, values))
+        if self.type == 'Date':
+            return struct.pack('<%dH' % len(values), *map(self.get_day, values))
+        if b'\\' in b''.join(values):
+            values = [unescape(value) for value in values]
+        if self.type == 'String':
+            return encode_strings(values)
+
+        # Array is a column of end offsets followed by column of all elements
+        elements, offsets = split_arrays(values, self.quoted)
+        return struct.pack('<%dQ' % len(offsets), *offsets) + self.nested.encode(elements)
+
+
+class BlockEncoder(object):
+    '''Converts blocks of TSV rows into blocks of ClickHouse Native format.
+
+    Rows are transposed into columns and every column is packed at once,
+    so ClickHouse neither parses text nor infers types while inserting.
+    DateTime values are sent as strings and converted by the server.'''
+
+    def __init__(self, header, ch_types):
+        self.columns = header.decode('utf-8').split('\t')
+        self.encoders = [ColumnEncoder(ch_types[column]) for column in self.columns]
+        self.column_headers = [encode_string(column.encode('utf-8')) +
+                               encode_string(encoder.type.encode('utf-8'))
+                               for column, encoder in zip(self.columns, self.encoders)]
+
+    def get_insert_query(self, table):
+        '''Returns query inserting encoded blocks into table'''
+        structure = ', '.join(column + ' ' + encoder.type
+                              for column, encoder in zip(self.columns, self.encoders))
+        return 'INSERT INTO {table} ({columns}) SELECT * FROM input(\'{structure}\') FORMAT Native' \
+            .format(table=table, columns=', '.join(self.columns), structure=structure)
+
+    def encode(self, block):
+        '''Returns Native block for newline-terminated TSV rows'''
+        rows = [line.split(b'\t') for line in block.split(b'\n')[:-1]]
+        data = [encode_varint(len(self.columns)), encode_varint(len(rows))]
+        for i, values in enumerate(zip(*rows)):
+            data.append(self.column_headers[i])
+            data.append(self.encoders[i].encode(values))
+        return b''.join(data)
+
+    def encode_blocks(self, blocks):
+        '''Yields Native blocks for TSV blocks'''
+        for block in blocks:
+            yield self.encode(block)
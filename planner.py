@@ -0,0 +1,90 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import datetime
+import logging
+import logs_api
+import request_manager
+import utils
+
+logger = logging.getLogger('logs_api')
+
+
+def is_final_period(date2_str):
+    '''Returns whether data for period can't change anymore'''
+    date2 = datetime.datetime.strptime(date2_str, utils.DATE_FORMAT)
+    return (datetime.datetime.today() - date2).days > 2
+
+
+def evaluate(user_request, date1_str, date2_str, state_store):
+    '''Returns Logs API evaluation for period using cached results if possible'''
+    estimation = state_store.get_evaluation(user_request, date1_str, date2_str)
+    if estimation is None:
+        estimation = logs_api.get_estimation(
+            user_request._replace(start_date_str=date1_str, end_date_str=date2_str))
+        logger.debug('Evaluation %s - %s: %s' % (date1_str, date2_str, estimation))
+        if is_final_period(date2_str):
+            state_store.save_evaluation(user_request, date1_str, date2_str, estimation)
+    return estimation
+
+
+def get_periods(user_request, state_store, max_days=0):
+    '''Splits period of UserRequest into the fewest continuous periods
+    which Logs API can prepare (and not longer than max_days, if it's set).
+
+    Periods are packed greedily: for each start date the longest possible
+    period is found with binary search over evaluations, starting from
+    max_possible_day_quantity of the remaining period as a first guess.
+    As any part of a possible period is possible too, this gives the minimal
+    number of requests even for uneven traffic.'''
+    dates = utils.get_dates(user_request.start_date_str, user_request.end_date_str)
+    periods = []
+    start = 0
+    while start < len(dates):
+        last = len(dates) - 1
+        if max_days:
+            last = min(last, start + max_days - 1)
+
+        estimation = evaluate(user_request, dates[start], dates[last], state_store)
+        if estimation['possible']:
+            periods.append((dates[start], dates[last], estimation))
+            start = last + 1
+            continue
+
+        # Binary search of the longest possible period [start, end]:
+        # end is known to be possible for lo (if lo >= start) and
+        # is not greater than hi
+        lo, hi = start - 1, last - 1
+        best = None
+        mid = min(start + max(estimation['max_possible_day_quantity'], 1) - 1, hi)
+        while lo < hi:
+            estimation = evaluate(user_request, dates[start], dates[mid], state_store)
+            if estimation['possible']:
+                lo, best = mid, estimation
+            else:
+                hi = mid - 1
+            mid = (lo + hi + 1) // 2
+
+        if best is None:
+            raise RuntimeError(
+                'Logs API can\'t load data for {date}: it\'s too large'.format(
+                    date=dates[start]))
+        periods.append((dates[start], dates[lo], best))
+        start = lo + 1
+    return periods
+
+
+def get_api_requests(user_request, state_store, max_days=0):
+    '''Returns list of API requests for UserRequest'''
+    api_requests = []
+    for date1_str, date2_str, estimation in get_periods(user_request, state_store, max_days):
+        request_manager.set_quota(user_request.counter_id, estimation)
+        api_requests.append(utils.Structure(
+            user_request=user_request,
+            date1_str=date1_str,
+            date2_str=date2_str,
+            max_day_quantity=estimation['max_possible_day_quantity'],
+            expected_size=estimation.get('expected_size', 0),
+            status='new'
+        ))
+    return api_requests
@@ -0,0 +1,103 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import datetime
+import time
+import utils
+
+
+class PollingStrategy(object):
+    '''Decides when statuses of Logs API requests should be checked.
+
+    Polling starts with a short delay which grows exponentially up to
+    max_delay. Time needed to prepare previous requests of the run is used
+    to predict readiness of the next ones: requests are weighted by number of
+    days relative to max_possible_day_quantity from evaluation, and no polls
+    are made until the predicted time comes.'''
+
+    def __init__(self, initial_delay=5, max_delay=120, backoff=2,
+                 deadline=None, clock=time.time):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.deadline = deadline
+        self.clock = clock
+        self.polls = 0
+        self.ready_times = []
+        self.total_weight = 0.0
+        self.total_ready_time = 0.0
+
+    def get_weight(self, api_request):
+        '''Returns size of request relative to the max possible one'''
+        date1 = datetime.datetime.strptime(api_request.date1_str, utils.DATE_FORMAT)
+        date2 = datetime.datetime.strptime(api_request.date2_str, utils.DATE_FORMAT)
+        days = (date2 - date1).days + 1
+        max_days = getattr(api_request, 'max_day_quantity', 0) or days
+        return days / max_days
+
+    def get_eta(self, api_request):
+        '''Returns predicted number of seconds to prepare request or None'''
+        if self.total_weight == 0:
+            return None
+        return api_request.weight * self.total_ready_time / self.total_weight
+
+    def start(self, api_request):
+        '''Registers newly created request and schedules its first poll'''
+        api_request.created_at = self.clock()
+        api_request.weight = self.get_weight(api_request)
+        api_request.polls = 0
+        api_request.poll_delay = self.initial_delay
+        self.schedule(api_request)
+
+    def schedule(self, api_request):
+        '''Sets time of the next status check for request'''
+        now = self.clock()
+        elapsed = now - api_request.created_at
+        if (self.deadline is not None) and (elapsed > self.deadline):
+            raise RuntimeError(
+                'Logs API request {request_id} is not ready after {secs} secs'
+                .format(request_id=api_request.request_id, secs=int(elapsed)))
+
+        eta = self.get_eta(api_request)
+        if (eta is not None) and (elapsed < eta):
+            delay = eta - elapsed
+        else:
+            delay = api_request.poll_delay
+            api_request.poll_delay = min(api_request.poll_delay * self.backoff,
+                                         self.max_delay)
+
+        delay = max(self.initial_delay, min(delay, self.max_delay))
+        if self.deadline is not None:
+            delay = min(delay, max(api_request.created_at + self.deadline - now, 0))
+        api_request.next_poll_time = now + delay
+
+    def get_due(self, api_requests):
+        '''Waits until some of requests should be polled and returns them'''
+        next_poll_time = min(r.next_poll_time for r in api_requests)
+        delay = next_poll_time - self.clock()
+        if delay > 0:
+            time.sleep(delay)
+        now = self.clock()
+        return [r for r in api_requests if r.next_poll_time <= now]
+
+    def record_poll(self, api_request):
+        '''Accounts a status check of request'''
+        self.polls += 1
+        api_request.polls += 1
+        if api_request.status == 'processed':
+            api_request.time_to_ready = self.clock() - api_request.created_at
+            self.ready_times.append(api_request.time_to_ready)
+            self.total_weight += api_request.weight
+            self.total_ready_time += api_request.time_to_ready
+        else:
+            self.schedule(api_request)
+
+    def get_metrics(self):
+        '''Returns polling statistics'''
+        ready = len(self.ready_times)
+        return {
+            'polls': self.polls,
+            'ready_requests': ready,
+            'avg_time_to_ready': sum(self.ready_times) / ready if ready else None,
+            'max_time_to_ready': max(self.ready_times) if ready else None
+        }
@@ -0,0 +1,143 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import logging
+import logs_api
+import metrics
+import threading
+import utils
+
+logger = logging.getLogger('logs_api')
+
+# Requests which can be downloaded now or after processing
+REUSABLE_STATUSES = ['created', 'processed']
+
+# Logs API requests of counters known in the run, shared by all jobs
+_lock = threading.Lock()
+_claimed = set()
+_sizes = {}
+_quotas = {}
+
+
+def reset():
+    '''Forgets requests of the previous run'''
+    with _lock:
+        _claimed.clear()
+        _sizes.clear()
+        _quotas.clear()
+
+
+def get_fields_key(fields):
+    return ','.join(sorted(field.lower() for field in fields))
+
+
+def get_size(request_info):
+    '''Returns size of prepared data of Logs API request in bytes'''
+    if request_info.get('size') is not None:
+        return request_info['size']
+    return sum(part.get('size', 0) for part in request_info.get('parts', []))
+
+
+def is_matching(request_info, api_request):
+    '''Returns whether Logs API request has data of API request'''
+    user_request = api_request.user_request
+    return (request_info['source'] == user_request.source) \
+        and (request_info['date1'] == api_request.date1_str) \
+        and (request_info['date2'] == api_request.date2_str) \
+        and (get_fields_key(request_info['fields']) == get_fields_key(user_request.fields))
+
+
+def is_abandoned(request_info, user_request):
+    '''Returns whether processed Logs API request has data of UserRequest
+    for dates inside its period, so it's a leftover of a failed run'''
+    return (request_info['status'] == 'processed') \
+        and (request_info['source'] == user_request.source) \
+        and (request_info['date1'] >= user_request.start_date_str) \
+        and (request_info['date2'] <= user_request.end_date_str) \
+        and (get_fields_key(request_info['fields']) == get_fields_key(user_request.fields))
+
+
+def sync(config, user_request, api_requests):
+    '''Lists Logs API requests of counter and matches them with API requests
+    of UserRequest: the ones with the same period, source and fields are
+    reused instead of creating new ones, other processed ones with data of
+    the period are cleaned as abandoned. Sizes of the rest are accounted
+    in the quota of counter'''
+    request_infos = logs_api.get_requests(user_request)
+    counter_id = user_request.counter_id
+    with _lock:
+        for api_request in api_requests:
+            if getattr(api_request, 'request_id', None) is not None:
+                _claimed.add(api_request.request_id)
+                continue
+            if not config['reuse_requests']:
+                continue
+            for request_info in request_infos:
+                if (request_info['request_id'] not in _claimed) \
+                        and (request_info['status'] in REUSABLE_STATUSES) \
+                        and is_matching(request_info, api_request):
+                    logger.info('### REUSING TASK %d' % request_info['request_id'])
+                    api_request.request_id = request_info['request_id']
+                    api_request.status = request_info['status']
+                    _claimed.add(api_request.request_id)
+                    metrics.increment('requests_reused')
+                    break
+        abandoned = [request_info for request_info in request_infos
+                     if config['clean_abandoned_requests']
+                     and request_info['request_id'] not in _claimed
+                     and is_abandoned(request_info, user_request)]
+        sizes = _sizes.setdefault(counter_id, {})
+        for request_info in request_infos:
+            if request_info['status'] in REUSABLE_STATUSES:
+                sizes[request_info['request_id']] = get_size(request_info)
+
+    for request_info in abandoned:
+        logger.info('### CLEANING ABANDONED TASK %d' % request_info['request_id'])
+        try:
+            logs_api.clean_data(utils.Structure(user_request=user_request,
+                                                request_id=request_info['request_id'],
+                                                status=request_info['status']))
+        except ValueError as e:
+            logger.warning('Task {request_id} can\'t be cleaned: {e}'.format(
+                request_id=request_info['request_id'], e=e))
+            continue
+        metrics.increment('requests_cleaned')
+        with _lock:
+            sizes.pop(request_info['request_id'], None)
+
+
+def set_quota(counter_id, estimation):
+    '''Updates quota of counter from Logs API evaluation if it reports one'''
+    if estimation.get('log_request_sum_max_size'):
+        with _lock:
+            _quotas[counter_id] = estimation['log_request_sum_max_size']
+
+
+def get_used_quota(counter_id):
+    '''Returns total size of prepared requests of counter known in the run'''
+    with _lock:
+        return sum(_sizes.get(counter_id, {}).values())
+
+
+def has_quota(config, api_request):
+    '''Returns whether expected data of API request fits into the quota'''
+    counter_id = api_request.user_request.counter_id
+    with _lock:
+        quota = _quotas.get(counter_id, config['logs_api_quota'])
+        used = sum(_sizes.get(counter_id, {}).values())
+    return used + getattr(api_request, 'expected_size', 0) <= quota
+
+
+def register(api_request):
+    '''Registers request of the run: it takes its expected size of quota
+    until it's processed and its real size is known'''
+    with _lock:
+        _claimed.add(api_request.request_id)
+        _sizes.setdefault(api_request.user_request.counter_id, {})[api_request.request_id] = \
+            getattr(api_request, 'data_size', None) or getattr(api_request, 'expected_size', 0)
+
+
+def release(api_request):
+    '''Returns quota taken by cleaned request'''
+    with _lock:
+        _sizes.get(api_request.user_request.counter_id, {}).pop(api_request.request_id, None)
@@ -0,0 +1,346 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+from multiprocessing.pool import ThreadPool
+import http_client
+import logs_api
+import metrics
+import planner
+import polling
+import request_manager
+import sinks
+import time
+import threading
+import logging
+import utils
+
+logger = logging.getLogger('logs_api')
+
+# Numbers of active Logs API requests per token, shared by all jobs
+_token_slots = {}
+_token_slots_lock = threading.Lock()
+
+FAILED_STATUSES = ['canceled', 'processing_failed',
+                   'cleaned_by_user', 'cleaned_automatically_as_too_old']
+
+
+def save_part(config, api_request, part, state_store=None):
+    '''Saves a single part of Logs API request, retrying only this part on failures.
+    Rejected requests (PermanentError) are not retried, neither are parts
+    which sink can't save again without duplicating rows (PartlySavedError)'''
+    sink = sinks.get_sink(config, state_store)
+    for i in range(config['part_retries']):
+        time.sleep(i * config['part_retries_delay'])
+        try:
+            sink.prepare_part(api_request, part)
+            logs_api.save_data(api_request, part, config['buffer_size'],
+                               config['download_compression'],
+                               config['rejected_rows_dir'],
+                               sink, config['queue_size'])
+            return part
+        except http_client.PermanentError:
+            raise
+        except Exception as e:
+            logger.warning('Part #{part}: attempt #{i} failed: {e}'.format(
+                part=part, i=i + 1, e=e))
+            if not sink.can_retry_part(api_request, part):
+                raise sinks.PartlySavedError(get_partly_saved_message(api_request, part, e))
+            if i == config['part_retries'] - 1:
+                raise
+
+
+def get_partly_saved_message(api_request, part=None, error=None):
+    return ('{part}Logs API request {request_id} failed after some of its rows '
+            'were inserted{error}, it is not saved again to avoid duplicates. '
+            'Delete rows of {date1} - {date2} (of counter {counter_id}) '
+            'from the table and run again, they will be loaded from scratch. '
+            'Staging load mode retries parts safely').format(
+        part='Part #{part} of '.format(part=part) if part is not None else '',
+        request_id=api_request.request_id,
+        error=' ({error})'.format(error=error) if error is not None else '',
+        date1=api_request.date1_str, date2=api_request.date2_str,
+        counter_id=api_request.user_request.counter_id)
+
+
+def check_partly_saved(config, api_requests, state_store):
+    '''Raises PartlySavedError if a resumed request has a partly saved part
+    (the one which failed or was interrupted after its rows started being
+    saved) and its rows are still in sink. Once they are deleted, the request
+    is loaded again from scratch'''
+    for api_request in api_requests:
+        if (api_request.status != 'partly_saved') \
+                and (getattr(api_request, 'request_id', None) is not None) \
+                and (state_store.get_started_parts(api_request)
+                     - state_store.get_saved_parts(api_request)):
+            api_request.status = 'partly_saved'
+            state_store.save_api_request(api_request)
+        if api_request.status != 'partly_saved':
+            continue
+        loaded_dates = sinks.get_sink(config).get_loaded_dates(
+            api_request.user_request._replace(start_date_str=api_request.date1_str,
+                                              end_date_str=api_request.date2_str))
+        if (loaded_dates is None) or loaded_dates:
+            raise sinks.PartlySavedError(get_partly_saved_message(api_request))
+        logger.info('Rows of partly saved request {request_id} are deleted, '
+                    'it is loaded again'.format(request_id=api_request.request_id))
+        state_store.forget_parts(api_request)
+        api_request.status = 'created'
+        state_store.save_api_request(api_request)
+
+
+def save_parts(config, api_request, state_store):
+    '''Saves all parts of Logs API request using a bounded pool of workers.
+    Parts which were saved by previous runs are skipped'''
+    saved = state_store.get_saved_parts(api_request)
+    parts = [part for part in range(api_request.size) if part not in saved]
+    if saved:
+        logger.info('%d parts are already saved' % len(saved))
+
+    def save(part):
+        try:
+            save_part(config, api_request, part, state_store)
+        except sinks.PartlySavedError:
+            # Later runs mustn't save the part again while its rows are there
+            api_request.status = 'partly_saved'
+            state_store.save_api_request(api_request)
+            raise
+        state_store.save_part(api_request, part)
+        return part
+
+    workers = min(config['parallel_parts'], len(parts))
+    if workers <= 1:
+        for part in parts:
+            logger.info('Part #' + str(part))
+            save(part)
+        return
+
+    # Parts are streamed, so memory is bounded by workers * (queue_size + buffer_size)
+    logger.info('Saving %d parts with %d workers' % (len(parts), workers))
+    pool = ThreadPool(workers)
+    try:
+        # imap keeps the order of parts, so progress is reported sequentially
+        for i, part in enumerate(pool.imap(save, parts)):
+            logger.info('Part #{part} saved ({done}/{total})'.format(
+                part=part, done=i + 1, total=len(parts)))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_polling_strategy(config):
+    '''Returns polling strategy configured by user'''
+    return polling.PollingStrategy(
+        initial_delay=config['polling_initial_delay'],
+        max_delay=config['polling_max_delay'],
+        backoff=config['polling_backoff'],
+        deadline=config['polling_deadline'] or None
+    )
+
+
+def get_missing_date_ranges(config, user_request, state_store):
+    '''Returns continuous periods of UserRequest which are not loaded yet.
+    Days of requests completed by previous runs are loaded, days with data
+    in sink are too unless an unfinished request has them: parts mix rows
+    of all days of request, so its days may be loaded partly'''
+    dates = utils.get_dates(user_request.start_date_str, user_request.end_date_str)
+    completed_dates = state_store.get_loaded_dates(user_request)
+    unfinished_dates = get_dates(state_store.get_api_requests(user_request))
+    loaded_dates = sinks.get_sink(config).get_loaded_dates(user_request)
+    if loaded_dates is None:
+        logger.warning('Table has no Date column: only days of completed requests are skipped')
+        loaded_dates = []
+
+    missing_dates = [date for date in dates
+                     if (date not in completed_dates)
+                     and ((date not in loaded_dates) or (date in unfinished_dates))]
+    return utils.get_date_ranges(missing_dates)
+
+
+def get_dates(api_requests):
+    '''Returns set of dates of API requests'''
+    return set(date for api_request in api_requests
+               for date in utils.get_dates(api_request.date1_str, api_request.date2_str))
+
+
+def get_api_requests(config, user_request, state_store, reload=False):
+    '''Returns API requests for UserRequest resuming unfinished ones which
+    have days of its period. Other days missing in sink are requested,
+    or all of them if the period should be reloaded'''
+    api_requests = state_store.get_api_requests(user_request)
+    if api_requests:
+        logger.info('### RESUMING %d API REQUESTS' % len(api_requests))
+        check_partly_saved(config, api_requests, state_store)
+
+    if reload:
+        date_ranges = [(user_request.start_date_str, user_request.end_date_str)]
+    else:
+        date_ranges = get_missing_date_ranges(config, user_request, state_store)
+    resumed_dates = get_dates(api_requests)
+    date_ranges = utils.get_date_ranges([
+        date for date1_str, date2_str in date_ranges
+        for date in utils.get_dates(date1_str, date2_str) if date not in resumed_dates])
+
+    for date1_str, date2_str in date_ranges:
+        logger.info('Loading dates: %s - %s' % (date1_str, date2_str))
+        gap_request = user_request._replace(start_date_str=date1_str,
+                                            end_date_str=date2_str)
+        for api_request in planner.get_api_requests(gap_request, state_store,
+                                                    config['max_days_per_request']):
+            # progress is tracked for the whole user request
+            api_request.user_request = user_request
+            state_store.save_api_request(api_request)
+            api_requests.append(api_request)
+    return api_requests
+
+
+def resume_task(api_request):
+    '''Returns whether a task created by previous run can be reused'''
+    if getattr(api_request, 'request_id', None) is None:
+        return False
+    logger.info('### RESUMING TASK %d' % api_request.request_id)
+    try:
+        logs_api.update_status(api_request)
+    except ValueError as e:
+        logger.warning('Task can\'t be resumed: {e}'.format(e=e))
+        return False
+    return api_request.status not in FAILED_STATUSES
+
+
+def acquire_token_slot(config, token):
+    '''Takes a slot for active request of token unless the limit is reached'''
+    limit = config['max_active_requests_per_token']
+    with _token_slots_lock:
+        used = _token_slots.get(token, 0)
+        if limit and used >= limit:
+            return False
+        _token_slots[token] = used + 1
+        return True
+
+
+def release_token_slot(token):
+    '''Returns slot for active request of token'''
+    with _token_slots_lock:
+        _token_slots[token] -= 1
+
+
+def replace_task(api_request, state_store):
+    '''Forgets parts of task of previous run which can't be reused.
+    If rows of its parts started being saved in direct load mode, they can't
+    be told from rows of a new task, so PartlySavedError is raised instead'''
+    if getattr(api_request, 'request_id', None) is None:
+        return
+    if state_store.get_started_parts(api_request):
+        api_request.status = 'partly_saved'
+        state_store.save_api_request(api_request)
+        raise sinks.PartlySavedError(get_partly_saved_message(api_request))
+    state_store.forget_parts(api_request)
+
+
+def create_task(api_request, state_store):
+    '''Creates Logs API task unless the one from previous run can be reused'''
+    if not resume_task(api_request):
+        replace_task(api_request, state_store)
+        logger.info('### CREATING TASK %s - %s' % (api_request.date1_str,
+                                                   api_request.date2_str))
+        logs_api.create_task(api_request)
+
+
+def submit_tasks(config, pending, active, polling_strategy, state_store):
+    '''Creates Logs API tasks ahead while there is room for them'''
+    while pending and ((not config['max_active_requests'])
+                       or (len(active) < config['max_active_requests'])):
+        api_request = pending[0]
+        if active and not request_manager.has_quota(config, api_request):
+            logger.info('Task is postponed: {mb} MB of Logs API quota is taken by prepared requests'
+                        .format(mb=request_manager.get_used_quota(
+                            api_request.user_request.counter_id) // (1024 * 1024)))
+            return
+        token = api_request.user_request.token
+        if not acquire_token_slot(config, token):
+            logger.info('Task is postponed: all requests of token are active')
+            return
+        try:
+            create_task(api_request, state_store)
+        except ValueError as e:
+            release_token_slot(token)
+            # Most likely the quota of Logs API is exhausted: wait until
+            # one of the active tasks is downloaded and cleaned
+            if not active:
+                raise
+            logger.warning('Task is postponed: {e}'.format(e=e))
+            return
+        logger.info(api_request)
+        request_manager.register(api_request)
+        state_store.save_api_request(api_request)
+        polling_strategy.start(api_request)
+        active.append(pending.pop(0))
+
+
+def wait_for_processed(active, polling_strategy, state_store):
+    '''Polls active tasks when they are due and returns the ones that are ready'''
+    while True:
+        due = polling_strategy.get_due(active)
+        if due:
+            logger.info('### CHECKING STATUS')
+        processed = []
+        for api_request in due:
+            logs_api.update_status(api_request)
+            logger.info('API Request {request_id} status: {status}'.format(
+                request_id=api_request.request_id, status=api_request.status))
+            if api_request.status in FAILED_STATUSES:
+                raise RuntimeError('Logs API request {request_id} is {status}'.format(
+                    request_id=api_request.request_id, status=api_request.status))
+            polling_strategy.record_poll(api_request)
+            state_store.save_api_request(api_request)
+            if api_request.status == 'processed':
+                logger.info('API Request {request_id} is ready in {secs} secs '
+                            'after {polls} polls'.format(
+                                request_id=api_request.request_id,
+                                secs=int(api_request.time_to_ready),
+                                polls=api_request.polls))
+                metrics.record('wait', api_request.time_to_ready)
+                request_manager.register(api_request)
+                processed.append(api_request)
+        if processed:
+            return processed
+
+
+def process_api_requests(config, api_requests, state_store):
+    '''Creates, waits for, saves and cleans Logs API requests.
+    Up to max_active_requests tasks are prepared on server at the same time
+    (and up to max_active_requests_per_token for all jobs with the same token)
+    while their expected size fits into Logs API quota of counter,
+    and the first ready one is downloaded first. Progress is recorded
+    in state store'''
+    polling_strategy = get_polling_strategy(config)
+    sink = sinks.get_sink(config)
+    if api_requests:
+        # Requests left on server by previous runs are reused or cleaned
+        request_manager.sync(config, api_requests[0].user_request, api_requests)
+    pending = list(api_requests)
+    active = []
+    try:
+        while pending or active:
+            submit_tasks(config, pending, active, polling_strategy, state_store)
+            if not active:
+                # Requests of the token are taken by other jobs
+                time.sleep(config['polling_initial_delay'])
+                continue
+            for api_request in wait_for_processed(active, polling_strategy, state_store):
+                logger.info('### SAVING DATA')
+                save_parts(config, api_request, state_store)
+                with metrics.timer('publish'):
+                    sink.publish(api_request)
+
+                logger.info('### CLEANING DATA')
+                logs_api.clean_data(api_request)
+                request_manager.release(api_request)
+                state_store.complete_api_request(api_request)
+                active.remove(api_request)
+                release_token_slot(api_request.user_request.token)
+    finally:
+        for api_request in active:
+            release_token_slot(api_request.user_request.token)
+
+    logger.info('Polling metrics: ' + str(polling_strategy.get_metrics()))
+    return polling_strategy.get_metrics()
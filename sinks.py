@@ -0,0 +1,403 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import itertools
+import logging
+import os
+
+import clickhouse
+import compression
+import native
+import utils
+
+logger = logging.getLogger('logs_api')
+
+FORMATS = ['tsv', 'parquet']
+
+# Extensions of TSV files compressed with codec
+EXTENSIONS = {
+    'none': '',
+    'gzip': '.gz',
+    'deflate': '.zz',
+    'zstd': '.zst'
+}
+
+# Arrow types of ClickHouse types, DateTime is local time of counter
+ARROW_TYPES = {
+    'UInt8': 'uint8',
+    'UInt16': 'uint16',
+    'UInt32': 'uint32',
+    'UInt64': 'uint64',
+    'Int8': 'int8',
+    'Int16': 'int16',
+    'Int32': 'int32',
+    'Int64': 'int64',
+    'Float32': 'float32',
+    'Float64': 'float64',
+    'Date': 'date32',
+    'String': 'string'
+}
+
+
+class PartlySavedError(RuntimeError):
+    '''Part failed after some of its rows were saved, so saving it again
+    would duplicate them'''
+
+
+class ClickHouseSink(object):
+    '''Inserts parts into ClickHouse table of source, in staging mode
+    into staging tables which are published once all parts are saved'''
+
+    def __init__(self, load_mode='direct', state_store=None):
+        self.load_mode = load_mode
+        self.state_store = state_store
+        self.sent_parts = set()
+
+    def prepare(self, user_request):
+        '''Checks schema before any data is requested'''
+        clickhouse.prepare_table(user_request.source, user_request.fields)
+
+    def get_loaded_dates(self, user_request):
+        '''Returns dates of period which already have data,
+        or None if it can't be known'''
+        if 'Date' not in clickhouse.get_table_columns(user_request.source):
+            return None
+        return clickhouse.get_loaded_dates(user_request.start_date_str,
+                                           user_request.end_date_str,
+                                           user_request.source,
+                                           user_request.counter_id)
+
+    def prepare_part(self, api_request, part):
+        '''Prepares saving of part, called before every attempt'''
+        if self.load_mode == 'staging':
+            # Every attempt starts with an empty table, so retries are idempotent
+            clickhouse.create_staging_table(api_request.user_request.source,
+                                            api_request.request_id, part)
+
+    def save_part(self, api_request, part, header, blocks):
+        '''Saves TSV blocks of part, header has ClickHouse column names'''
+        table = None
+        if self.load_mode == 'staging':
+            table = clickhouse.get_staging_table_name(api_request.user_request.source,
+                                                      api_request.request_id, part)
+        else:
+            blocks = self.track_sent(api_request, part, blocks)
+        clickhouse.save_data(api_request.user_request.source,
+                             api_request.user_request.fields,
+                             itertools.chain([header + b'\n'], blocks), table)
+
+    def track_sent(self, api_request, part, blocks):
+        '''Passes blocks on remembering that rows of part were sent,
+        in state store as well before the first of them, so later runs
+        know that the part may be inserted partly'''
+        for block in blocks:
+            if (api_request.request_id, part) not in self.sent_parts:
+                if self.state_store is not None:
+                    self.state_store.start_part(api_request, part)
+                self.sent_parts.add((api_request.request_id, part))
+            yield block
+
+    def can_retry_part(self, api_request, part):
+        '''Returns whether failed part can be saved again without duplicating
+        rows: in direct mode rows sent before the failure may be inserted
+        already, as ClickHouse commits blocks of INSERT as they arrive'''
+        return (api_request.request_id, part) not in self.sent_parts
+
+    def publish(self, api_request):
+        '''Makes data of all saved parts of request visible'''
+        if self.load_mode == 'staging':
+            logger.info('### PUBLISHING DATA')
+            clickhouse.publish_staging(api_request.user_request.source,
+                                       api_request.request_id,
+                                       range(api_request.size),
+                                       api_request.date1_str,
+                                       api_request.date2_str,
+                                       api_request.user_request.counter_id)
+
+
+class ColumnsSink(ClickHouseSink):
+    '''Fills columns of rows already loaded into ClickHouse table of source.
+    Parts with key fields and the fields to add are inserted into a Join
+    table of request, which is merged into the table by ALTER TABLE UPDATE
+    once all parts are saved, so only the new columns are downloaded
+    and rewritten'''
+
+    @staticmethod
+    def get_fields(source, fields):
+        '''Returns fields to request for adding fields to loaded rows'''
+        keys = clickhouse.KEY_FIELDS[source]
+        return keys + [field for field in fields if field not in keys]
+
+    def prepare(self, user_request):
+        '''Adds columns for new fields to the table'''
+        if not (clickhouse.is_db_present() and clickhouse.is_table_present(user_request.source)):
+            raise ValueError('Table {table} doesn\'t exist: load data before adding fields'
+                             .format(table=clickhouse.get_source_table_name(user_request.source)))
+        key_fields = clickhouse.KEY_FIELDS[user_request.source]
+        clickhouse.validate_table_columns(user_request.source,
+                                          [field for field in key_fields
+                                           if not field.endswith(':counterID')])
+        # Keys are matched by the columns table already has, so only
+        # the new fields get columns (CounterID stays absent if it was)
+        clickhouse.add_columns(user_request.source,
+                               [field for field in user_request.fields
+                                if field not in key_fields])
+
+    def get_loaded_dates(self, user_request):
+        '''Returns dates of period which need no update as they have no rows'''
+        dates_with_rows = super(ColumnsSink, self).get_loaded_dates(user_request)
+        return [date_str for date_str in utils.get_dates(user_request.start_date_str,
+                                                         user_request.end_date_str)
+                if date_str not in dates_with_rows]
+
+    def prepare_part(self, api_request, part):
+        clickhouse.create_columns_table(api_request.user_request.source,
+                                        api_request.request_id,
+                                        api_request.user_request.fields)
+
+    def save_part(self, api_request, part, header, blocks):
+        clickhouse.save_data(api_request.user_request.source,
+                             api_request.user_request.fields,
+                             itertools.chain([header + b'\n'], blocks),
+                             clickhouse.get_columns_table_name(
+                                 api_request.user_request.source, api_request.request_id))
+
+    def publish(self, api_request):
+        logger.info('### UPDATING COLUMNS')
+        clickhouse.update_columns(api_request.user_request.source,
+                                  api_request.request_id,
+                                  api_request.user_request.fields,
+                                  api_request.date1_str,
+                                  api_request.date2_str,
+                                  api_request.user_request.counter_id)
+
+
+class FileSink(object):
+    '''Writes parts into files under directory/counter_id/source/date/,
+    one file per part and date, so they can be loaded later with
+    clickhouse-local or INSERT ... FROM INFILE. Files are written block
+    by block and renamed into place once the part is complete'''
+
+    def __init__(self, directory, file_format='tsv', codec='gzip'):
+        assert file_format in FORMATS, 'Unknown file format: ' + file_format
+        if file_format == 'parquet':
+            if import_pyarrow() is None:
+                raise RuntimeError('parquet format requires pyarrow library: '
+                                   'pip install pyarrow')
+            assert codec in ['none', 'gzip', 'zstd'], \
+                'Unknown compression for parquet: ' + codec
+        else:
+            compression.validate_codec(codec)
+        self.directory = directory
+        self.file_format = file_format
+        self.codec = codec
+
+    def get_source_dir(self, user_request):
+        return os.path.join(self.directory, str(user_request.counter_id),
+                            user_request.source)
+
+    def get_path(self, api_request, part, date_str):
+        '''Returns path of file with rows of part for date'''
+        if self.file_format == 'parquet':
+            extension = '.parquet'
+        else:
+            extension = '.tsv' + EXTENSIONS[self.codec]
+        return os.path.join(self.get_source_dir(api_request.user_request), date_str,
+                            '{request_id}_{part}{extension}'.format(
+                                request_id=api_request.request_id,
+                                part=part, extension=extension))
+
+    def prepare(self, user_request):
+        pass
+
+    def get_loaded_dates(self, user_request):
+        '''Returns dates of period which have directories with complete files
+        (the ones left by killed processes keep .tmp suffix)'''
+        source_dir = self.get_source_dir(user_request)
+        return [date_str for date_str in utils.get_dates(user_request.start_date_str,
+                                                         user_request.end_date_str)
+                if os.path.isdir(os.path.join(source_dir, date_str))
+                and any(not name.endswith('.tmp')
+                        for name in os.listdir(os.path.join(source_dir, date_str)))]
+
+    def prepare_part(self, api_request, part):
+        pass
+
+    def can_retry_part(self, api_request, part):
+        '''Files of failed part are removed, so it can always be saved again'''
+        return True
+
+    def save_part(self, api_request, part, header, blocks):
+        '''Writes TSV blocks of part into files split by date'''
+        columns = header.split(b'\t')
+        date_index = columns.index(b'Date') if b'Date' in columns else None
+        # Without Date column rows of the part go to directory of its period
+        period = '{date1}_{date2}'.format(date1=api_request.date1_str,
+                                          date2=api_request.date2_str)
+        ch_types = clickhouse.get_ch_types(api_request.user_request.fields)
+        writers = {}
+        try:
+            for block in blocks:
+                for date_str, lines in self.split_by_date(block, date_index, period):
+                    if date_str not in writers:
+                        path = self.get_path(api_request, part, date_str)
+                        self.remove_replaced(api_request, os.path.dirname(path))
+                        writers[date_str] = self.open_writer(path, header, ch_types)
+                    writers[date_str].write(lines)
+        except Exception:
+            for writer in writers.values():
+                writer.discard()
+            raise
+        for writer in writers.values():
+            writer.close()
+
+    def remove_replaced(self, api_request, directory):
+        '''Removes files of other Logs API requests from directory of date,
+        left by the ones which failed or were replaced, so rows of the date
+        are not loaded twice'''
+        if not os.path.isdir(directory):
+            return
+        prefix = '{request_id}_'.format(request_id=api_request.request_id)
+        for name in os.listdir(directory):
+            if not name.startswith(prefix):
+                os.remove(os.path.join(directory, name))
+
+    def split_by_date(self, block, date_index, period):
+        '''Returns pairs of date and its lines of block'''
+        if date_index is None:
+            return [(period, block.split(b'\n')[:-1])]
+        dates = {}
+        for line in block.split(b'\n')[:-1]:
+            date = line.split(b'\t', date_index + 1)[date_index]
+            dates.setdefault(date, []).append(line)
+        return [(date.decode('utf-8'), lines) for date, lines in dates.items()]
+
+    def open_writer(self, path, header, ch_types):
+        if self.file_format == 'parquet':
+            return ParquetWriter(path, header, self.codec, ch_types)
+        return TsvWriter(path, header, self.codec)
+
+    def publish(self, api_request):
+        pass
+
+
+class TsvWriter(object):
+    '''Writes lines into compressed TSV file with names,
+    the file gets its name only when it is closed'''
+
+    def __init__(self, path, header, codec):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass  # already exists
+        self.path = path
+        self.file = open(path + '.tmp', 'wb')
+        self.compressor = None
+        if codec != 'none':
+            self.compressor = compression.get_compressor(codec)
+        self.write_data(header + b'\n')
+
+    def write_data(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.file.write(data)
+
+    def write(self, lines):
+        self.write_data(b'\n'.join(lines) + b'\n')
+
+    def close(self):
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+        self.file.close()
+        os.rename(self.path + '.tmp', self.path)
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.path + '.tmp')
+
+
+def import_pyarrow():
+    '''Returns PyArrow module or None if it isn't installed. It's imported
+    on first use, so importing this module stays cheap'''
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def get_arrow_type(ch_type):
+    '''Returns Arrow type for ClickHouse type, DateTime is kept as text'''
+    pyarrow = import_pyarrow()
+    if ch_type.startswith('Array('):
+        return pyarrow.list_(get_arrow_type(ch_type[6:-1]))
+    return getattr(pyarrow, ARROW_TYPES.get(ch_type, 'string'))()
+
+
+def get_arrow_array(values, ch_type):
+    '''Returns Arrow array for column values in TSV text format'''
+    pyarrow = import_pyarrow()
+    arrow_type = get_arrow_type(ch_type)
+    if ch_type.startswith('Array('):
+        if b'\\' in b''.join(values):
+            values = [native.unescape(value) for value in values]
+        quoted = not ch_type[6:-1] in native.FIXED_TYPES
+        elements, offsets = native.split_arrays(values, quoted)
+        return pyarrow.ListArray.from_arrays(
+            pyarrow.array([0] + offsets, pyarrow.int32()),
+            get_arrow_array(elements, ch_type[6:-1]))
+    if ch_type in native.FIXED_TYPES:
+        cast = float if ch_type.startswith('Float') else int
+        return pyarrow.array(list(map(cast, values)), arrow_type)
+    if ch_type == 'Date':
+        return pyarrow.array(values, pyarrow.string()).cast(arrow_type)
+    if b'\\' in b''.join(values):
+        values = [native.unescape(value) for value in values]
+    return pyarrow.array(values, arrow_type)
+
+
+class ParquetWriter(object):
+    '''Writes lines into Parquet file with a row group per block,
+    the file gets its name only when it is closed'''
+
+    def __init__(self, path, header, codec, ch_types):
+        pyarrow = import_pyarrow()
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass  # already exists
+        self.columns = header.decode('utf-8').split('\t')
+        self.types = [ch_types[column] for column in self.columns]
+        self.schema = pyarrow.schema([(column, get_arrow_type(ch_type))
+                                      for column, ch_type in zip(self.columns, self.types)])
+        self.path = path
+        self.writer = pyarrow.parquet.ParquetWriter(path + '.tmp', self.schema,
+                                                    compression=codec)
+
+    def write(self, lines):
+        pyarrow = import_pyarrow()
+        columns = zip(*[line.split(b'\t') for line in lines])
+        arrays = [get_arrow_array(list(values), ch_type)
+                  for values, ch_type in zip(columns, self.types)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+        os.rename(self.path + '.tmp', self.path)
+
+    def discard(self):
+        self.writer.close()
+        os.remove(self.path + '.tmp')
+
+
+def get_sink(config, state_store=None):
+    '''Returns sink for downloaded parts configured by user,
+    state_store records parts which rows started being saved'''
+    if config['sink'] == 'columns':
+        return ColumnsSink()
+    if config['sink'] == 'file':
+        return FileSink(config['file_sink']['directory'],
+                        config['file_sink']['format'],
+                        config['file_sink']['compression'])
+    return ClickHouseSink(config['clickhouse']['load_mode'], state_store)
@@ -0,0 +1,214 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import json
+import sqlite3
+import threading
+import utils
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS api_requests (
+        job TEXT NOT NULL,
+        date1 TEXT NOT NULL,
+        date2 TEXT NOT NULL,
+        max_day_quantity INTEGER,
+        request_id INTEGER,
+        status TEXT NOT NULL,
+        size INTEGER,
+        PRIMARY KEY (job, date1, date2)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS parts (
+        job TEXT NOT NULL,
+        request_id INTEGER NOT NULL,
+        part INTEGER NOT NULL,
+        PRIMARY KEY (job, request_id, part)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS started_parts (
+        job TEXT NOT NULL,
+        request_id INTEGER NOT NULL,
+        part INTEGER NOT NULL,
+        PRIMARY KEY (job, request_id, part)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS loaded_dates (
+        job TEXT NOT NULL,
+        date TEXT NOT NULL,
+        PRIMARY KEY (job, date)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS evaluations (
+        request TEXT NOT NULL,
+        date1 TEXT NOT NULL,
+        date2 TEXT NOT NULL,
+        evaluation TEXT NOT NULL,
+        PRIMARY KEY (request, date1, date2)
+    )
+    '''
+]
+
+DONE_STATUSES = ['cleaned_by_user', 'cleaned_automatically_as_too_old']
+
+
+def get_job_key(user_request):
+    '''Returns key identifying data of user request regardless of the period'''
+    return '{counter_id}|{source}|{fields}'.format(
+        counter_id=user_request.counter_id,
+        source=user_request.source,
+        fields=','.join(sorted(user_request.fields))
+    )
+
+
+class StateStore(object):
+    '''Journal of Logs API requests, saved parts and loaded days kept
+    in SQLite, so that interrupted loads can be resumed'''
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path or ':memory:',
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            for query in SCHEMA:
+                self.connection.execute(query)
+
+    def get_api_requests(self, user_request):
+        '''Returns unfinished API requests with days of period of user request.
+        They are kept whatever period the run has, so the days they have
+        (which may be partly saved) are loaded by the next run having any of them'''
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT date1, date2, max_day_quantity, request_id, status, size '
+                'FROM api_requests WHERE job = ? AND date1 <= ? AND date2 >= ? '
+                'ORDER BY date1',
+                (get_job_key(user_request), user_request.end_date_str,
+                 user_request.start_date_str)
+            ).fetchall()
+
+        api_requests = []
+        for date1, date2, max_day_quantity, request_id, status, size in rows:
+            if status in DONE_STATUSES:
+                continue
+            api_request = utils.Structure(
+                user_request=user_request,
+                date1_str=date1,
+                date2_str=date2,
+                max_day_quantity=max_day_quantity,
+                status=status
+            )
+            if request_id is not None:
+                api_request.request_id = request_id
+            if size is not None:
+                api_request.size = size
+            api_requests.append(api_request)
+        return api_requests
+
+    def save_api_request(self, api_request):
+        '''Records current state of API request'''
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO api_requests '
+                '(job, date1, date2, max_day_quantity, request_id, status, size) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (get_job_key(api_request.user_request),
+                 api_request.date1_str,
+                 api_request.date2_str,
+                 getattr(api_request, 'max_day_quantity', None),
+                 getattr(api_request, 'request_id', None),
+                 api_request.status,
+                 getattr(api_request, 'size', None))
+            )
+
+    def get_saved_parts(self, api_request):
+        '''Returns set of parts of API request which are already saved'''
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT part FROM parts WHERE job = ? AND request_id = ?',
+                (get_job_key(api_request.user_request), api_request.request_id)
+            ).fetchall()
+        return set(row[0] for row in rows)
+
+    def save_part(self, api_request, part):
+        '''Records that part of API request is saved'''
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO parts (job, request_id, part) VALUES (?, ?, ?)',
+                (get_job_key(api_request.user_request), api_request.request_id, part)
+            )
+
+    def start_part(self, api_request, part):
+        '''Records that rows of part of API request started being saved'''
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO started_parts (job, request_id, part) VALUES (?, ?, ?)',
+                (get_job_key(api_request.user_request), api_request.request_id, part)
+            )
+
+    def get_started_parts(self, api_request):
+        '''Returns set of parts of API request which rows started being saved'''
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT part FROM started_parts WHERE job = ? AND request_id = ?',
+                (get_job_key(api_request.user_request), api_request.request_id)
+            ).fetchall()
+        return set(row[0] for row in rows)
+
+    def forget_parts(self, api_request):
+        '''Removes records of saved and started parts of API request'''
+        with self.lock, self.connection:
+            for table in ['parts', 'started_parts']:
+                self.connection.execute(
+                    'DELETE FROM {table} WHERE job = ? AND request_id = ?'.format(table=table),
+                    (get_job_key(api_request.user_request), api_request.request_id)
+                )
+
+    def get_evaluation(self, user_request, date1_str, date2_str):
+        '''Returns cached Logs API evaluation for period or None'''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT evaluation FROM evaluations '
+                'WHERE request = ? AND date1 = ? AND date2 = ?',
+                (get_job_key(user_request), date1_str, date2_str)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_evaluation(self, user_request, date1_str, date2_str, evaluation):
+        '''Caches Logs API evaluation for period'''
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO evaluations (request, date1, date2, evaluation) '
+                'VALUES (?, ?, ?, ?)',
+                (get_job_key(user_request), date1_str, date2_str,
+                 json.dumps(evaluation))
+            )
+
+    def complete_api_request(self, api_request):
+        '''Records days of API request as loaded and drops its records'''
+        job = get_job_key(api_request.user_request)
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO loaded_dates (job, date) VALUES (?, ?)',
+                [(job, date_str) for date_str in utils.get_dates(api_request.date1_str,
+                                                                 api_request.date2_str)])
+            self.connection.execute(
+                'DELETE FROM api_requests WHERE job = ? AND date1 = ? AND date2 = ?',
+                (job, api_request.date1_str, api_request.date2_str))
+            for table in ['parts', 'started_parts']:
+                self.connection.execute(
+                    'DELETE FROM {table} WHERE job = ? AND request_id = ?'.format(table=table),
+                    (job, getattr(api_request, 'request_id', None)))
+
+    def get_loaded_dates(self, user_request):
+        '''Returns set of dates of period which were loaded completely'''
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT date FROM loaded_dates WHERE job = ? AND date >= ? AND date <= ?',
+                (get_job_key(user_request), user_request.start_date_str,
+                 user_request.end_date_str)
+            ).fetchall()
+        return set(row[0] for row in rows)
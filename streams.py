@@ -0,0 +1,153 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import collections
+import threading
+import time
+
+
+class BlockQueue(object):
+    '''Queue of byte blocks holding up to max_size bytes (but at least one
+    block), so a fast producer waits for a slow consumer and memory stays
+    bounded. Time the sides spent waiting for each other and occupancy
+    of the queue are collected'''
+
+    def __init__(self, max_size, clock=time.time):
+        self.max_size = max_size
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.blocks = collections.deque()
+        self.size = 0
+        self.finished = False
+        self.stopped = False
+        self.error = None
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+        self.max_queued = 0
+        self.queued_integral = 0.0
+        self.started_at = self.updated_at = clock()
+
+    def account(self):
+        '''Adds time since the last change weighted by queued bytes'''
+        now = self.clock()
+        self.queued_integral += self.size * (now - self.updated_at)
+        self.updated_at = now
+
+    def put(self, block):
+        '''Adds block waiting for room, returns False if consumer has stopped'''
+        with self.condition:
+            start = self.clock()
+            while self.blocks and (self.size + len(block) > self.max_size) \
+                    and not self.stopped:
+                self.condition.wait()
+            self.put_wait += self.clock() - start
+            if self.stopped:
+                return False
+            self.account()
+            self.blocks.append(block)
+            self.size += len(block)
+            self.max_queued = max(self.max_queued, self.size)
+            self.condition.notify_all()
+            return True
+
+    def finish(self, error=None):
+        '''Marks the end of blocks, error is raised to consumer after them'''
+        with self.condition:
+            self.finished = True
+            self.error = error
+            self.condition.notify_all()
+
+    def get(self):
+        '''Returns the next block waiting for it, or None after the last one'''
+        with self.condition:
+            start = self.clock()
+            while not self.blocks and not self.finished:
+                self.condition.wait()
+            self.get_wait += self.clock() - start
+            if not self.blocks:
+                if self.error is not None:
+                    raise self.error
+                return None
+            self.account()
+            block = self.blocks.popleft()
+            self.size -= len(block)
+            self.condition.notify_all()
+            return block
+
+    def stop(self):
+        '''Makes producer stop, remaining blocks are dropped'''
+        with self.condition:
+            self.stopped = True
+            self.blocks.clear()
+            self.size = 0
+            self.condition.notify_all()
+
+    def get_stats(self):
+        with self.condition:
+            self.account()
+            seconds = self.updated_at - self.started_at
+            return {
+                'put_wait': self.put_wait,
+                'get_wait': self.get_wait,
+                'max_bytes': self.max_queued,
+                'avg_bytes': int(self.queued_integral / seconds) if seconds > 0 else 0
+            }
+
+
+class Prefetcher(object):
+    '''Iterates over blocks of iterable in background thread ahead of
+    consumer through BlockQueue of max_size bytes, so producing (e.g.
+    download and parsing) and consuming (e.g. insert) run at the same time.
+    Errors of producer are raised to consumer'''
+
+    def __init__(self, iterable, max_size):
+        self.queue = BlockQueue(max_size)
+        self.thread = threading.Thread(target=self.produce, args=(iterable,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def produce(self, iterable):
+        try:
+            for block in iterable:
+                if not self.queue.put(block):
+                    return
+        except Exception as e:
+            self.queue.finish(e)
+        else:
+            self.queue.finish()
+
+    def __iter__(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                return
+            yield block
+
+    def stop(self):
+        self.queue.stop()
+
+    def join(self):
+        self.thread.join()
+
+
+def iter_groups(blocks, max_size):
+    '''Splits blocks into consecutive groups of up to max_size bytes
+    (at least one block), 0 - a single group. Each group is an iterator
+    which must be consumed before the next one is taken'''
+    blocks = iter(blocks)
+    first = next(blocks, None)
+    while first is not None:
+        rest = []
+
+        def group(block):
+            size = 0
+            while True:
+                yield block
+                size += len(block)
+                block = next(blocks, None)
+                if (block is None) or (max_size and (size + len(block) > max_size)):
+                    rest.append(block)
+                    return
+
+        yield group(first)
+        first = rest[0] if rest else None
@@ -0,0 +1,137 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import itertools
+import os
+
+
+def import_numpy():
+    '''Returns NumPy module or None if it isn't installed. It's imported
+    on first use, so importing this module stays cheap'''
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def iter_blocks(chunks):
+    '''Regroups byte chunks into blocks of whole newline-terminated lines'''
+    pending = b''
+    for chunk in chunks:
+        end = chunk.rfind(b'\n') + 1
+        if end == 0:
+            pending += chunk
+            continue
+        yield pending + chunk[:end]
+        pending = chunk[end:]
+    if pending:
+        yield pending + b'\n'
+
+
+def iter_batches(lines, buffer_size):
+    '''Groups lines into newline-terminated blocks of about buffer_size bytes'''
+    batch = []
+    batch_size = 0
+    for line in lines:
+        batch.append(line)
+        batch_size += len(line) + 1
+        if batch_size >= buffer_size:
+            yield b'\n'.join(batch) + b'\n'
+            batch = []
+            batch_size = 0
+    if batch:
+        yield b'\n'.join(batch) + b'\n'
+
+
+def split_header(blocks):
+    '''Returns header line and iterator over blocks with rows'''
+    blocks = iter(blocks)
+    for block in blocks:
+        header, _, rest = block.partition(b'\n')
+        if rest:
+            return header, itertools.chain([rest], blocks)
+        return header, blocks
+    return None, blocks
+
+
+def rename_header(header, rename):
+    '''Applies rename function to every column name of TSV header'''
+    names = header.decode('utf-8').split('\t')
+    return '\t'.join(map(rename, names)).encode('utf-8')
+
+
+class RowsTransformer(object):
+    '''Validates number of columns and corrects escapes in TSV rows.
+
+    Rows are processed by blocks: valid blocks are passed on without
+    being rejoined, so per-row Python work is a single bytes.count call.
+    If NumPy is installed, numbers of columns of all rows in a block are
+    counted at once and Python loops are needed only for invalid blocks.
+    Rows with wrong number of columns are dropped and optionally written
+    to a side file.'''
+
+    def __init__(self, header, rejected_path=None, use_numpy=True):
+        self.header = header
+        self.numpy = import_numpy() if use_numpy else None
+        self.use_numpy = self.numpy is not None
+        self.tabs = header.count(b'\t')
+        self.rows = 0
+        self.rejected = 0
+        self.rejected_path = rejected_path
+        self.rejected_file = None
+
+    def is_valid(self, block):
+        '''Returns whether all rows of block have proper number of columns
+        and number of rows in it, or (None, None) without NumPy'''
+        if not self.use_numpy:
+            return None, None
+        numpy = self.numpy
+        data = numpy.frombuffer(block, dtype=numpy.uint8)
+        newlines = numpy.flatnonzero(data == 10)
+        tabs = numpy.flatnonzero(data == 9)
+        # number of tabs before each newline gives tabs per row
+        tabs_per_row = numpy.diff(numpy.searchsorted(tabs, newlines), prepend=0)
+        return bool((tabs_per_row == self.tabs).all()), len(newlines)
+
+    def transform(self, block):
+        '''Returns block with valid rows only and corrected escapes'''
+        valid, rows = self.is_valid(block)
+        if not valid:
+            lines = block.split(b'\n')
+            lines.pop()  # block ends with newline
+            tabs = self.tabs
+            bad = [line for line in lines if line.count(b'\t') != tabs]
+            if bad:
+                self.reject(bad)
+                good = [line for line in lines if line.count(b'\t') == tabs]
+                block = b'\n'.join(good) + b'\n' if good else b''
+            rows = len(lines) - len(bad)
+        self.rows += rows
+        return block.replace(b"\\'", b"'") # to correct escapes in params
+
+    def transform_blocks(self, blocks):
+        '''Yields transformed non-empty blocks'''
+        for block in blocks:
+            block = self.transform(block)
+            if block:
+                yield block
+
+    def reject(self, lines):
+        '''Accounts rejected rows and writes them to side file if needed'''
+        self.rejected += len(lines)
+        if not self.rejected_path:
+            return
+        if self.rejected_file is None:
+            try:
+                os.makedirs(os.path.dirname(self.rejected_path))
+            except OSError:
+                pass  # already exists
+            self.rejected_file = open(self.rejected_path, 'wb')
+            self.rejected_file.write(self.header + b'\n')
+        self.rejected_file.write(b'\n'.join(lines) + b'\n')
+
+    def close(self):
+        if self.rejected_file is not None:
+            self.rejected_file.close()
+            self.rejected_file = None
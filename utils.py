@@ -3,11 +3,24 @@ from __future__ import (absolute_import, division,
 
 import json
 import argparse
-import requests
+import datetime
+import compression
+import http_client
 import platform
+import threading
 
 DATE_FORMAT = '%Y-%m-%d'
 
+# Max number of days in Logs API request in staging load mode: every day
+# is a partition, and ClickHouse rejects inserts into more partitions
+# than max_partitions_per_insert_block (100 by default)
+MAX_STAGING_DAYS = 100
+
+# Configs of ClickHouse columns read during the run, they are shared
+# by all callers and must not be modified
+_configs = {}
+_configs_lock = threading.Lock()
+
 class Structure:
     def __init__(self, **kwds):
         self.__dict__.update(kwds)
@@ -26,14 +39,14 @@ def validate_user_request(user_request):
 
 def validate_cli_options(options):
     '''Validates command line options'''
-    assert options.source is not None, \
+    assert (options.source is not None) or options.jobs, \
         'Source must be specified in CLI options'
     if options.mode is None:
         assert (options.start_date is not None) \
             and (options.end_date is not None), \
             'Dates or mode must be specified'
     else:
-        assert options.mode in ['history', 'regular', 'regular_early'], \
+        assert options.mode in ['history', 'regular', 'regular_early', 'daemon'], \
             'Wrong mode in CLI options'
 
 
@@ -42,8 +55,14 @@ def get_cli_options():
     parser = argparse.ArgumentParser()
     parser.add_argument('-start_date', help = 'Start of period')
     parser.add_argument('-end_date', help = 'End of period')
-    parser.add_argument('-mode', help = 'Mode (one of [history, reqular, regular_early])')
+    parser.add_argument('-mode', help = 'Mode (one of [history, reqular, regular_early, daemon])')
     parser.add_argument('-source', help = 'Source (hits or visits)')
+    parser.add_argument('-jobs', action = 'store_true',
+                        help = 'Load all counters and sources listed in jobs of config')
+    parser.add_argument('-add_fields',
+                        help = 'Comma-separated fields to add to data already loaded for the period')
+    parser.add_argument('-reload', action = 'store_true',
+                        help = 'Replace data already loaded for the period (staging load mode only)')
     options = parser.parse_args()
     validate_cli_options(options)
     return options
@@ -57,10 +76,12 @@ def get_counter_creation_date(counter_id, token):
 
     headers = {'Authorization': 'OAuth ' + token}
 
-    r = requests.get(url, headers=headers)
+    r = http_client.get_client('metrika').get(url, headers=headers)
     if r.status_code == 200:
         date = json.loads(r.text)['counter']['create_time'].split('T')[0]
         return date
+    else:
+        http_client.raise_error(r)
 
 
 def get_config():
@@ -72,14 +93,104 @@ def get_config():
     assert 'token' in config, 'Token must be specified in config'
     assert 'retries' in config, 'Number of retries should be specified in config'
     assert 'retries_delay' in config, 'Delay between retries should be specified in config'
+    config.setdefault('buffer_size', 1048576)
+    config.setdefault('queue_size', 16777216)
+    config.setdefault('parallel_parts', 1)
+    config.setdefault('part_retries', 3)
+    config.setdefault('part_retries_delay', 10)
+    config.setdefault('max_active_requests', 1)
+    config.setdefault('max_days_per_request', 0)
+    config.setdefault('polling_initial_delay', 5)
+    config.setdefault('polling_max_delay', 120)
+    config.setdefault('polling_backoff', 2)
+    config.setdefault('polling_deadline', 0)
+    config.setdefault('state_file', './state.db')
+    config.setdefault('http', {})
+    config.setdefault('jobs', [])
+    config.setdefault('max_parallel_jobs', 1)
+    config.setdefault('max_active_requests_per_token', 0)
+    config.setdefault('reuse_requests', 1)
+    config.setdefault('clean_abandoned_requests', 0)
+    config.setdefault('logs_api_quota', 10737418240)
+    config.setdefault('daemon', {})
+    config['daemon'].setdefault('interval', 1800)
+    config['daemon'].setdefault('lookback_days', 7)
+    config['daemon'].setdefault('delay_days', 2)
+    config['daemon'].setdefault('status_host', '127.0.0.1')
+    config['daemon'].setdefault('status_port', 8090)
+    # loaded days are not reloaded, and data of yesterday may be incomplete
+    assert config['daemon']['lookback_days'] >= config['daemon']['delay_days'] >= 2, \
+        'daemon should load days from lookback_days ago up to delay_days ago (at least 2)'
+    config.setdefault('download_compression', 'gzip')
+    config.setdefault('rejected_rows_dir', '')
+    config.setdefault('report_file', './report.json')
+    config.setdefault('prometheus_file', '')
+    config.setdefault('sink', 'clickhouse')
+    assert config['sink'] in ['clickhouse', 'file'], 'sink should be clickhouse or file'
+    config.setdefault('file_sink', {})
+    config['file_sink'].setdefault('directory', './data')
+    config['file_sink'].setdefault('format', 'tsv')
+    config['file_sink'].setdefault('compression', 'gzip')
+    config['clickhouse'].setdefault('compression', 'none')
+    config['clickhouse'].setdefault('load_mode', 'direct')
+    assert config['clickhouse']['load_mode'] in ['direct', 'staging'], \
+        'load_mode should be direct or staging'
+    config['clickhouse'].setdefault('table_layout', 'modern')
+    assert config['clickhouse']['table_layout'] in ['modern', 'legacy'], \
+        'table_layout should be modern or legacy'
+    assert (config['clickhouse']['load_mode'] != 'staging') or \
+        (config['clickhouse']['table_layout'] == 'modern'), \
+        'staging load_mode requires modern table_layout'
+    if (config['sink'] == 'clickhouse') and (config['clickhouse']['load_mode'] == 'staging'):
+        config['max_days_per_request'] = min(config['max_days_per_request'] or MAX_STAGING_DAYS,
+                                             MAX_STAGING_DAYS)
+    config['clickhouse'].setdefault('insert_format', 'tsv')
+    assert config['clickhouse']['insert_format'] in ['tsv', 'native'], \
+        'insert_format should be tsv or native'
+    config['clickhouse'].setdefault('insert_block_size', 104857600)
+    assert config['download_compression'] in ['gzip', 'none'], \
+        'download_compression should be gzip or none'
+    compression.validate_codec(config['clickhouse']['compression'])
     return config
 
 
+def get_cached_config(path):
+    '''Returns JSON config from file reading it only on first access'''
+    with _configs_lock:
+        if path not in _configs:
+            with open(path) as input_file:
+                _configs[path] = json.loads(input_file.read())
+        return _configs[path]
+
+
 def get_ch_fields_config():
     '''Returns config for ClickHouse columns\'s datatypes'''
-    with open('./configs/ch_types.json') as input_file:
-        ch_field_types = json.loads(input_file.read())
-    return ch_field_types
+    return get_cached_config('./configs/ch_types.json')
+
+def get_dates(start_date_str, end_date_str):
+    '''Returns list of all dates of period'''
+    start_date = datetime.datetime.strptime(start_date_str, DATE_FORMAT)
+    end_date = datetime.datetime.strptime(end_date_str, DATE_FORMAT)
+    return [(start_date + datetime.timedelta(i)).strftime(DATE_FORMAT)
+            for i in range((end_date - start_date).days + 1)]
+
+
+def get_date_ranges(dates):
+    '''Coalesces dates into minimal list of continuous (start, end) periods'''
+    ranges = []
+    for date_str in sorted(set(dates)):
+        date = datetime.datetime.strptime(date_str, DATE_FORMAT)
+        if ranges and (date - ranges[-1][1]).days == 1:
+            ranges[-1][1] = date
+        else:
+            ranges.append([date, date])
+    return [(start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT))
+            for start, end in ranges]
+
+
+def get_ch_layout_config():
+    '''Returns config for layout of ClickHouse tables (partitioning, ordering, codecs)'''
+    return get_cached_config('./configs/ch_layout.json')
 
 def get_python_version():
     return platform.python_version()